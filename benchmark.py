@@ -0,0 +1,149 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from functools import partial
+
+import numpy as np
+
+from borbely import BorbelyModel
+from config import configurations, default_params
+
+# Benchmarks for the simulation, episode extraction and plotting hot paths.
+# Each case is timed (best of --repeat runs) and run once more under tracemalloc for its peak memory.
+# Results are written as JSON; --compare flags cases that got slower than a saved baseline.
+
+GRIDS = {
+    # (horizon in days, step in hours, population size)
+    'quick': {'days': [1, 30], 'dt': [0.5, 0.1], 'population': [1, 100]},
+    'full': {'days': [1, 30, 365, 3650], 'dt': [0.5, 0.1, 1 / 60], 'population': [1, 100, 10000]},
+}
+
+def _simulated(model, ts):
+    return model.simulate(ts, 0.1, True)
+
+# Each setup prepares its inputs (untimed) and returns the callable that is timed
+SETUPS = {
+    'simulate': lambda model, ts: lambda: model.simulate(ts, 0.1, True),
+    'simulate_events': lambda model, ts: lambda: model.simulate_events(ts[0], ts[-1], 0.1, True),
+    'calculate_sleep_pressure': lambda model, ts: partial(model.calculate_sleep_pressure, ts, 0.1, _simulated(model, ts).awake),
+    'calculate_sleep_pressure_scan': lambda model, ts: partial(model.calculate_sleep_pressure_scan, ts, 0.1, _simulated(model, ts).awake),
+    'determine_sleep_wake_state': lambda model, ts: partial(model.determine_sleep_wake_state, ts, *_sleep_wake_inputs(model, ts)),
+    'identify_sleep_periods': lambda model, ts: _simulated(model, ts).identify_sleep_periods,
+}
+
+def _sleep_wake_inputs(model, ts):
+    sleep_data = _simulated(model, ts)
+    return sleep_data.H, sleep_data.upper, sleep_data.lower, True
+
+def _setup_simulate_batch(model, ts, population):
+    table = [{'circadian_amplitude': amplitude} for amplitude in np.linspace(0.05, 0.5, population)]
+    return lambda: model.simulate_batch(table, ts, 0.1, True)
+
+def _setup_plot_configurations(model, ts):
+    # Render the six-panel figure headlessly; matplotlib is only imported for this case.
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from visualizations import plot_configurations
+
+    def run():
+        plot_configurations(configurations, BorbelyModel(default_params), ts, 0.1, True)
+        plt.close('all')
+    return run
+
+def _cases(grid, max_steps):
+    # Yield (name, case parameters, setup returning the callable to time) over the grid.
+    # Single runs longer than max_steps are skipped, as are batches of more than 100 * max_steps subject-steps.
+    model = BorbelyModel()
+    for days in grid['days']:
+        for dt in grid['dt']:
+            ts = np.arange(0, 24 * days, dt)
+            if len(ts) > max_steps:
+                continue
+            case = {'days': days, 'dt': dt, 'steps': len(ts)}
+
+            for name, setup in SETUPS.items():
+                yield name, case, partial(setup, model, ts)
+            for population in grid['population']:
+                if population * len(ts) <= 100 * max_steps:
+                    yield 'simulate_batch', {**case, 'population': population}, partial(_setup_simulate_batch, model, ts, population)
+            if len(ts) <= max_steps // 10:
+                yield 'plot_configurations', case, partial(_setup_plot_configurations, model, ts)
+
+def measure(setup, repeat):
+    # Return (best wall time in seconds, peak traced memory in bytes) of the callable built by setup.
+    run = setup()
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+def run_benchmarks(grid, repeat=3, max_steps=200_000, only=None):
+    results = []
+    for name, case, setup in _cases(grid, max_steps):
+        if only and name not in only:
+            continue
+        seconds, peak = measure(setup, repeat)
+        results.append({'benchmark': name, **case, 'seconds': seconds, 'peak_bytes': peak})
+        print(f"{name:32s} {json.dumps(case):60s} {seconds * 1e3:10.2f} ms {peak / 2**20:9.2f} MiB")
+    return results
+
+def _case_key(result):
+    return json.dumps({key: value for key, value in result.items() if key not in ('seconds', 'peak_bytes')}, sort_keys=True)
+
+def compare(results, baseline, threshold):
+    # Return the cases whose time or peak memory grew by more than threshold x the baseline.
+    reference = {_case_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = reference.get(_case_key(result))
+        if before is None:
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            if before[metric] > 0 and result[metric] > threshold * before[metric]:
+                regressions.append({'case': _case_key(result), 'metric': metric, 'baseline': before[metric], 'current': result[metric], 'ratio': result[metric] / before[metric]})
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Borbely model hot paths.')
+    parser.add_argument('--grid', choices=sorted(GRIDS), default='quick')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-steps', type=int, default=200_000, help='skip single-run cases with more time steps than this')
+    parser.add_argument('--only', nargs='*', help='run only these benchmarks')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='baseline JSON written by an earlier run')
+    parser.add_argument('--threshold', type=float, default=1.25, help='ratio to the baseline that counts as a regression')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(GRIDS[args.grid], args.repeat, args.max_steps, args.only)
+    report = {
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'grid': args.grid,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression['case']} {regression['metric']}: {regression['baseline']:.4g} -> {regression['current']:.4g} ({regression['ratio']:.2f}x)")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
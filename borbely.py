@@ -1,7 +1,15 @@
+import json
+import logging
+import os
+from collections.abc import Sequence
+
 import numpy as np
-import matplotlib.pyplot as plt
 
 from config import default_params
+from instrumentation import logger, metrics
+
+# Parameters that determine ProcessC, i.e. the upper and lower bounds
+CIRCADIAN_KEYS = ('circadian_frequency', 'circadian_phase_shift', 'circadian_amplitude', 'UpperBound_Sleep_Pressure', 'LowerBound_Sleep_Pressure')
 
 class ProcessS:
     # Process S in the Borbely model represents homeostatic sleep pressure that builds up during wakefulness and dissipates during sleep.
@@ -21,17 +29,35 @@ class ProcessC:
         self.UpperBound_Sleep_Pressure = UpperBound_Sleep_Pressure  # UpperBound_Sleep_Pressure: The baseline level of the upper turning bound.
         self.LowerBound_Sleep_Pressure = LowerBound_Sleep_Pressure  # LowerBound_Sleep_Pressure: The baseline level of the lower turning bound.
 
-    def calculate_circadian_rhythm(self, t):
+    def calculate_circadian_rhythm(self, t, phase=None):
         # Calculate the circadian oscillation, a sinusoidal function representing the 24-hour sleep-wake cycle.
-        return self.circadian_amplitude * np.sin(self.circadian_frequency * t - self.circadian_phase_shift)
+        # phase, if given, replaces circadian_frequency * t - circadian_phase_shift (e.g. phases of a KuramotoPopulation).
+        if phase is None:
+            phase = self.circadian_frequency * t - self.circadian_phase_shift
+        return self.circadian_amplitude * np.sin(phase)
 
-    def calculate_upper_bound(self, t):
+    def calculate_upper_bound(self, t, phase=None):
         # Calculate the upper bound, the sleep pressure threshold for inducing sleep.
-        return self.UpperBound_Sleep_Pressure + self.circadian_amplitude * self.calculate_circadian_rhythm(t)
+        return self.UpperBound_Sleep_Pressure + self.circadian_amplitude * self.calculate_circadian_rhythm(t, phase)
 
-    def calculate_lower_bound(self, t):
+    def calculate_lower_bound(self, t, phase=None):
         # Calculate the lower bound, the sleep pressure threshold for inducing wakefulness.
-        return self.LowerBound_Sleep_Pressure + self.circadian_amplitude * self.calculate_circadian_rhythm(t)
+        return self.LowerBound_Sleep_Pressure + self.circadian_amplitude * self.calculate_circadian_rhythm(t, phase)
+
+def _affine_scan(a, b):
+    # Inclusive prefix composition of the affine maps x -> a[..., i] * x + b[..., i] along the last axis.
+    # Uses log2(T) doubling passes (Hillis-Steele), which only multiply decay factors <= 1 and never divide,
+    # so it stays stable over arbitrarily long horizons.
+    a = np.array(a, dtype=float)
+    b = np.array(b, dtype=float)
+    offset = 1
+    while offset < a.shape[-1]:
+        a_prev = a[..., :-offset].copy()
+        b_prev = b[..., :-offset].copy()
+        b[..., offset:] += a[..., offset:] * b_prev
+        a[..., offset:] *= a_prev
+        offset *= 2
+    return a, b
 
 class BorbelyModel:
     # This class represents the Borbely model.
@@ -63,6 +89,25 @@ class BorbelyModel:
 
         return H
 
+    def calculate_sleep_pressure_scan(self, ts, H0, awake):
+        # Vectorized calculate_sleep_pressure for a known wake schedule.
+        # Every step is the affine map H_i = a_i * H_{i-1} + b_i, so H follows from a cumulative scan of the maps.
+        # ts and awake may be (T,) or (N, T) for a batch of schedules, H0 a scalar or (N,).
+        ts = np.asarray(ts, dtype=float)
+        awake = np.asarray(awake, dtype=bool)
+        dt = np.diff(ts, axis=-1)
+        baseline = self.params['Wake_Baseline_Pressure']
+        max_pressure = self.params['Max_Sleep_Pressure']
+
+        wake_decay = np.exp(-dt / self.params['Wake_Decay_Rate'])
+        sleep_decay = np.exp(-dt / self.params['Sleep_Decay_Rate'])
+        a = np.where(awake[..., :-1], wake_decay, sleep_decay) / max_pressure
+        b = np.where(awake[..., :-1], baseline * (1 - wake_decay), 0.0) / max_pressure
+        a, b = _affine_scan(a, b)
+
+        H_first = np.asarray(H0, dtype=float)[..., None] / max_pressure
+        return np.concatenate([np.broadcast_to(H_first, a.shape[:-1] + (1,)), a * H_first + b], axis=-1)
+
     def determine_sleep_wake_state(self, ts, H, upper, lower, wake_status_T0):
         # Determine sleep/wake state based on sleep pressure and upper/lower bounds.
         awake = np.full(len(ts), np.nan, dtype=bool)
@@ -85,23 +130,11 @@ class BorbelyModel:
 
         return awake, sleep_starts, sleep_ends
 
-    def simulate(self, ts, sleep_pressure_T0, wake_status_T0=False):
-        # Simulate the Borbely model.
-        print(f"Wakefulness Threshold: {self.params['Wake_Baseline_Pressure']}")
-
-        # Get upper and lower bounds
-        upper = self.process_c.calculate_upper_bound(ts)
-        lower = self.process_c.calculate_lower_bound(ts)
-
-        # Initialize arrays
-        H = np.full(len(ts), np.nan)
-        H[0] = sleep_pressure_T0
-        awake = np.full(len(ts), wake_status_T0, dtype=bool)
-
+    def _integrate(self, ts, H, awake, upper, lower):
+        # Fill H[1:] and awake[1:] in place from the state at ts[0] and return the switch times.
         sleep_starts = []
         sleep_ends = []
 
-        # Calculate sleep pressure and determine sleep/wake state
         for i in range(1, len(ts)):
             dt = ts[i] - ts[i-1]
             H[i] = awake[i-1] * self.Ha(dt, H[i-1]) + (not awake[i-1]) * self.process_s.calculate_sleep_pressure(dt, H[i-1])
@@ -115,18 +148,454 @@ class BorbelyModel:
             else:
                 awake[i] = awake[i-1]
 
+        return sleep_starts, sleep_ends
+
+    def simulate(self, ts, sleep_pressure_T0, wake_status_T0=False):
+        # Simulate the Borbely model.
+        logger.debug("Wakefulness Threshold: %s", self.params['Wake_Baseline_Pressure'])
+
+        # Get upper and lower bounds
+        with metrics.phase('bounds'):
+            upper = self.process_c.calculate_upper_bound(ts)
+            lower = self.process_c.calculate_lower_bound(ts)
+
+        # Initialize arrays
+        H = np.full(len(ts), np.nan)
+        H[0] = sleep_pressure_T0
+        awake = np.full(len(ts), wake_status_T0, dtype=bool)
+
+        # Calculate sleep pressure and determine sleep/wake state
+        with metrics.phase('integration'):
+            sleep_starts, sleep_ends = self._integrate(ts, H, awake, upper, lower)
+        metrics.count('simulations')
+        metrics.count('steps', len(ts))
+        metrics.count('switches', len(sleep_starts) + len(sleep_ends))
+
         # Add the end of the simulation as the end time of the last sleep period if necessary
         if len(sleep_starts) > len(sleep_ends):
             sleep_ends.append(ts[-1])
             
         # Return simulation results as an instance of SleepData
-        sleep_data = SleepData(ts, H, awake, upper, lower, sleep_starts, sleep_ends, self.process_c.calculate_circadian_rhythm)        
-        sleep_data.identify_sleep_periods()  # Print the sleep periods by index
+        sleep_data = SleepData(ts, H, awake, upper, lower, sleep_starts, sleep_ends, self.process_c.calculate_circadian_rhythm, self.params)
+        if logger.isEnabledFor(logging.DEBUG):
+            sleep_data.identify_sleep_periods()  # Log the sleep periods by index
+        return sleep_data
+
+    def simulate_checkpointed(self, ts, sleep_pressure_T0, wake_status_T0=False, interval=24 * 7, on_checkpoint=None):
+        # Simulate like simulate(), taking a Checkpoint every interval hours and at the last step.
+        # on_checkpoint, if given, is called with each Checkpoint as soon as it is taken (e.g. to save it,
+        # so an interrupted run can be resumed). The checkpoints are also kept in sleep_data.checkpoints.
+        ts = np.asarray(ts, dtype=float)
+        with metrics.phase('bounds'):
+            upper = self.process_c.calculate_upper_bound(ts)
+            lower = self.process_c.calculate_lower_bound(ts)
+
+        H = np.full(len(ts), np.nan)
+        H[0] = sleep_pressure_T0
+        awake = np.full(len(ts), wake_status_T0, dtype=bool)
+
+        stops = np.searchsorted(ts, np.arange(ts[0] + interval, ts[-1], interval))
+        stops = np.unique(np.append(stops[stops > 0], len(ts) - 1))
+
+        sleep_starts = []
+        sleep_ends = []
+        checkpoints = []
+        start = 0
+        for stop in stops:
+            chunk = slice(start, stop + 1)
+            with metrics.phase('integration'):
+                starts, ends = self._integrate(ts[chunk], H[chunk], awake[chunk], upper[chunk], lower[chunk])
+            sleep_starts += starts
+            sleep_ends += ends
+            checkpoint = Checkpoint(ts[stop], stop, H[stop], awake[stop], sleep_starts, sleep_ends, self.params)
+            checkpoints.append(checkpoint)
+            if on_checkpoint is not None:
+                on_checkpoint(checkpoint)
+            start = stop
+        metrics.count('simulations')
+        metrics.count('steps', len(ts))
+        metrics.count('switches', len(sleep_starts) + len(sleep_ends))
+
+        if len(sleep_starts) > len(sleep_ends):
+            sleep_ends.append(ts[-1])
+
+        sleep_data = SleepData(ts, H, awake, upper, lower, sleep_starts, sleep_ends, self.process_c.calculate_circadian_rhythm, self.params)
+        sleep_data.checkpoints = checkpoints
+        return sleep_data
+
+    def resume(self, checkpoint, ts, params=None, previous=None):
+        # Continue from checkpoint over the part of ts from checkpoint.t onward (checkpoint.t must be on ts),
+        # with self.params updated by params from there on. Only that suffix is integrated.
+        # With previous, the SleepData the checkpoint was taken from, the result is spliced onto its prefix
+        # and covers previous.time[:checkpoint.index] followed by the suffix; otherwise it starts at checkpoint.t.
+        # The switch lists always include the switches before the checkpoint.
+        model = self if params is None else BorbelyModel({**self.params, **params})
+        ts = np.asarray(ts, dtype=float)
+        first = np.searchsorted(ts, checkpoint.t)
+        if first == len(ts) or ts[first] != checkpoint.t:
+            raise ValueError(f"Checkpoint time {checkpoint.t} is not on the time grid")
+        suffix = ts[first:]
+
+        with metrics.phase('bounds'):
+            upper = model.process_c.calculate_upper_bound(suffix)
+            lower = model.process_c.calculate_lower_bound(suffix)
+        H = np.full(len(suffix), np.nan)
+        H[0] = checkpoint.H
+        awake = np.full(len(suffix), checkpoint.awake, dtype=bool)
+        with metrics.phase('integration'):
+            starts, ends = model._integrate(suffix, H, awake, upper, lower)
+        metrics.count('steps', len(suffix))
+        metrics.count('switches', len(starts) + len(ends))
+
+        sleep_starts = list(checkpoint.sleep_starts) + starts
+        sleep_ends = list(checkpoint.sleep_ends) + ends
+        if len(sleep_starts) > len(sleep_ends):
+            sleep_ends.append(suffix[-1])
+
+        calculate_circadian_rhythm = model.process_c.calculate_circadian_rhythm
+        if previous is not None:
+            if previous.time[checkpoint.index] != checkpoint.t:
+                raise ValueError("Checkpoint was not taken from previous")
+            prefix = slice(0, checkpoint.index)
+            suffix = np.concatenate([previous.time[prefix], suffix])
+            H = np.concatenate([previous.H[prefix], H])
+            awake = np.concatenate([previous.awake[prefix], awake])
+            upper = np.concatenate([previous.upper[prefix], upper])
+            lower = np.concatenate([previous.lower[prefix], lower])
+            if params is not None:
+                before, after = previous.calculate_circadian_rhythm, model.process_c.calculate_circadian_rhythm
+                calculate_circadian_rhythm = lambda t: np.where(np.asarray(t) < checkpoint.t, before(t), after(t))
+
+        return SleepData(suffix, H, awake, upper, lower, sleep_starts, sleep_ends, calculate_circadian_rhythm, model.params)
+
+    def resimulate_from(self, previous, t, params=None, ts=None):
+        # What-if re-simulation: keep previous up to the first grid point at or after t and recompute
+        # only the rest, with params changed from there on and/or on a longer time grid ts.
+        index = min(np.searchsorted(previous.time, t), len(previous.time) - 1)
+        checkpoint = Checkpoint.from_sleep_data(previous, index)
+        return self.resume(checkpoint, previous.time if ts is None else ts, params, previous)
+
+    def simulate_until_periodic(self, ts, sleep_pressure_T0, wake_status_T0=False, tolerance=1e-10, max_cycle_days=7):
+        # Simulate like simulate(), but stop integrating once the trajectory has settled into a limit cycle.
+        # (H, awake) is sampled once per circadian period at a fixed phase (a Poincare map); when a sample
+        # repeats one of the previous max_cycle_days samples within tolerance, the remaining output is tiled
+        # from that cycle. The returned SleepData gets transient_length and cycle_period in hours
+        # (both None when no cycle was found or ts is not a uniform grid with a whole number of steps per period).
+        ts = np.asarray(ts, dtype=float)
+        with metrics.phase('bounds'):
+            upper = self.process_c.calculate_upper_bound(ts)
+            lower = self.process_c.calculate_lower_bound(ts)
+
+        H = np.full(len(ts), np.nan)
+        H[0] = sleep_pressure_T0
+        awake = np.full(len(ts), wake_status_T0, dtype=bool)
+
+        period = 2 * np.pi / self.params['circadian_frequency']
+        dt = ts[1] - ts[0] if len(ts) > 1 else period
+        steps_per_period = int(round(period / dt))
+        uniform = len(ts) > 1 and np.allclose(np.diff(ts), dt) and np.isclose(steps_per_period * dt, period)
+
+        transient_length = None
+        cycle_period = None
+        integrated_steps = len(ts)
+        if not uniform:
+            with metrics.phase('integration'):
+                self._integrate(ts, H, awake, upper, lower)
+        else:
+            # Integrate one period at a time, checking the Poincare section after each
+            section = 0
+            while section * steps_per_period < len(ts) - 1:
+                start = section * steps_per_period
+                stop = min(start + steps_per_period, len(ts) - 1)
+                with metrics.phase('integration'):
+                    self._integrate(ts[start:stop + 1], H[start:stop + 1], awake[start:stop + 1], upper[start:stop + 1], lower[start:stop + 1])
+                section += 1
+                if stop < section * steps_per_period:
+                    break
+
+                repeats = [days for days in range(1, min(max_cycle_days, section) + 1)
+                           if awake[stop - days * steps_per_period] == awake[stop] and abs(H[stop - days * steps_per_period] - H[stop]) <= tolerance]
+                if repeats:
+                    cycle_steps = repeats[0] * steps_per_period
+                    cycle_start = stop - cycle_steps
+                    remaining = np.arange(stop + 1, len(ts))
+                    source = cycle_start + (remaining - cycle_start) % cycle_steps
+                    H[remaining] = H[source]
+                    awake[remaining] = awake[source]
+                    transient_length = ts[cycle_start] - ts[0]
+                    cycle_period = repeats[0] * period
+                    integrated_steps = stop + 1
+                    break
+
+        # Read the switch times off the transitions in the awake array
+        sleep_starts = list(ts[1:][awake[:-1] & ~awake[1:]])
+        sleep_ends = list(ts[1:][~awake[:-1] & awake[1:]])
+        # Only the integrated steps are counted, not the ones tiled from the cycle
+        metrics.count('simulations')
+        metrics.count('steps', integrated_steps)
+        metrics.count('switches', len(sleep_starts) + len(sleep_ends))
+        if len(sleep_starts) > len(sleep_ends):
+            sleep_ends.append(ts[-1])
+
+        sleep_data = SleepData(ts, H, awake, upper, lower, sleep_starts, sleep_ends, self.process_c.calculate_circadian_rhythm, self.params)
+        sleep_data.transient_length = transient_length
+        sleep_data.cycle_period = cycle_period
+        return sleep_data
+
+    def iter_simulate(self, t_start, t_end, dt, chunk_hours, sleep_pressure_T0, wake_status_T0=False):
+        # Simulate on the grid np.arange(t_start, t_end, dt) and yield it as consecutive SleepData chunks
+        # of chunk_hours each. Only the last (t, H, awake) is carried between chunks, so memory stays
+        # constant however long the horizon. Each chunk lists only the switches that happen inside it.
+        n_steps = int(np.ceil((t_end - t_start) / dt))
+        delta = (t_start + dt) - t_start  # np.arange spaces its values by this rounded step
+        steps_per_chunk = max(1, int(round(chunk_hours / dt)))
+        H_prev, awake_prev = sleep_pressure_T0, wake_status_T0
+        metrics.count('simulations')
+
+        for first in range(0, n_steps, steps_per_chunk):
+            # Prepend the carried-over state, except for the first chunk which starts at t_start itself
+            carry = 1 if first > 0 else 0
+            ts = t_start + np.arange(first - carry, min(first + steps_per_chunk, n_steps)) * delta
+            with metrics.phase('bounds'):
+                upper = self.process_c.calculate_upper_bound(ts)
+                lower = self.process_c.calculate_lower_bound(ts)
+
+            H = np.full(len(ts), np.nan)
+            H[0] = H_prev
+            awake = np.full(len(ts), awake_prev, dtype=bool)
+            with metrics.phase('integration'):
+                sleep_starts, sleep_ends = self._integrate(ts, H, awake, upper, lower)
+            metrics.count('steps', len(ts) - carry)
+            metrics.count('switches', len(sleep_starts) + len(sleep_ends))
+            H_prev, awake_prev = H[-1], awake[-1]
+
+            yield SleepData(ts[carry:], H[carry:], awake[carry:], upper[carry:], lower[carry:], sleep_starts, sleep_ends, self.process_c.calculate_circadian_rhythm, self.params)
+
+    def batch_params(self, params_table):
+        # Expand a table of parameter overrides into arrays of shape (N,), one entry per subject.
+        # params_table is either a list of dicts (e.g. config.configurations) or a dict of scalars/arrays.
+        # Non-numeric entries such as 'title' or 'simulation_key' are left out.
+        keys = [key for key, value in self.params.items() if not isinstance(value, str)]
+        if isinstance(params_table, dict):
+            columns = {key: np.asarray(value, dtype=float) for key, value in params_table.items() if key in keys}
+            n_subjects = max([column.size for column in columns.values() if column.ndim > 0], default=1)
+            return {key: np.broadcast_to(np.asarray(columns.get(key, self.params[key]), dtype=float), (n_subjects,)).copy() for key in keys}
+
+        rows = [{**self.params, **overrides} for overrides in params_table]
+        return {key: np.array([row[key] for row in rows], dtype=float) for key in keys}
+
+    def simulate_batch(self, params_table, ts, H0, awake0=False, circadian_phase=None):
+        # Simulate N parameter sets at once. Every step advances all N trajectories together,
+        # using the same arithmetic as simulate() so each row matches the per-subject result exactly.
+        # circadian_phase, an optional (N, T) array, replaces circadian_frequency * ts - circadian_phase_shift.
+        params = self.batch_params(params_table)
+        n_subjects = len(params['Sleep_Decay_Rate'])
+        ts = np.asarray(ts, dtype=float)
+
+        # Get upper and lower bounds, shape (N, T)
+        with metrics.phase('bounds'):
+            if circadian_phase is None:
+                circadian_phase = params['circadian_frequency'][:, None] * ts - params['circadian_phase_shift'][:, None]
+            amplitude = params['circadian_amplitude'][:, None]
+            circadian_rhythm = amplitude * np.sin(circadian_phase)
+            upper = params['UpperBound_Sleep_Pressure'][:, None] + amplitude * circadian_rhythm
+            lower = params['LowerBound_Sleep_Pressure'][:, None] + amplitude * circadian_rhythm
+
+        # Initialize arrays
+        H = np.full((n_subjects, len(ts)), np.nan)
+        H[:, 0] = H0
+        awake = np.empty((n_subjects, len(ts)), dtype=bool)
+        awake[:, 0] = awake0
+
+        wake_baseline = params['Wake_Baseline_Pressure']
+        wake_decay_rate = params['Wake_Decay_Rate']
+        sleep_decay_rate = params['Sleep_Decay_Rate']
+
+        # Calculate sleep pressure and determine sleep/wake state for all subjects
+        with metrics.phase('integration'):
+            for i in range(1, len(ts)):
+                dt = ts[i] - ts[i-1]
+                H_wake = wake_baseline + (H[:, i-1] - wake_baseline) * np.exp(-dt / wake_decay_rate)
+                H_sleep = H[:, i-1] * np.exp(-dt / sleep_decay_rate)
+                H[:, i] = np.where(awake[:, i-1], H_wake, H_sleep)
+
+                falls_asleep = awake[:, i-1] & (H[:, i] >= upper[:, i])
+                wakes_up = ~awake[:, i-1] & (H[:, i] <= lower[:, i])
+                awake[:, i] = (awake[:, i-1] & ~falls_asleep) | wakes_up
+        logger.debug("Simulated a batch of %d subjects over %d steps", n_subjects, len(ts))
+        metrics.count('simulations', n_subjects)
+        metrics.count('steps', n_subjects * len(ts))
+
+        return BatchSleepData(ts, H, awake, upper, lower, params)
+
+    def simulate_population(self, params_table, ts, H0, awake0=False, dtype=np.float32, keep_H=True):
+        # Memory-lean simulate_batch for large populations; returns PopulationSleepData.
+        # The state is kept in dtype (float32 by default), the wake state is bit-packed as it is produced,
+        # and upper/lower are computed once per distinct set of circadian parameters and shared by index.
+        # With keep_H=False only the final sleep pressure is kept. See validate_population for the error bounds.
+        params = self.batch_params(params_table)
+        n_subjects = len(params['Sleep_Decay_Rate'])
+        ts = np.asarray(ts, dtype=float)
+        n_steps = len(ts)
+
+        # Distinct circadian parameter sets, shape (U, 5), and the set each subject uses
+        circadian = np.column_stack([params[key] for key in CIRCADIAN_KEYS])
+        circadian, bound_index = np.unique(circadian, axis=0, return_inverse=True)
+        bound_index = bound_index.ravel()
+        with metrics.phase('bounds'):
+            frequency, phase_shift, amplitude, upper_base, lower_base = (column[:, None] for column in circadian.T)
+            circadian_rhythm = amplitude * np.sin(frequency * ts - phase_shift)
+            upper = (upper_base + amplitude * circadian_rhythm).astype(dtype)
+            lower = (lower_base + amplitude * circadian_rhythm).astype(dtype)
+        shared = len(circadian) == 1
+
+        H = np.empty((n_subjects, n_steps), dtype=dtype) if keep_H else None
+        awake_bits = np.empty((n_subjects, (n_steps + 7) // 8), dtype=np.uint8)
+        block = np.empty((n_subjects, 8), dtype=bool)
+
+        H_now = np.empty(n_subjects, dtype=dtype)
+        H_now[:] = H0
+        awake_now = np.empty(n_subjects, dtype=bool)
+        awake_now[:] = awake0
+        H_wake = np.empty_like(H_now)
+        H_sleep = np.empty_like(H_now)
+        switched = np.empty(n_subjects, dtype=bool)
+
+        wake_baseline = params['Wake_Baseline_Pressure'].astype(dtype)
+        dts = np.diff(ts)
+        uniform = len(dts) > 0 and np.all(dts == dts[0])
+        if uniform:
+            wake_decay = np.exp(-dts[0] / params['Wake_Decay_Rate']).astype(dtype)
+            sleep_decay = np.exp(-dts[0] / params['Sleep_Decay_Rate']).astype(dtype)
+
+        with metrics.phase('integration'):
+            for i in range(n_steps):
+                if i > 0:
+                    if not uniform:
+                        wake_decay = np.exp(-dts[i-1] / params['Wake_Decay_Rate']).astype(dtype)
+                        sleep_decay = np.exp(-dts[i-1] / params['Sleep_Decay_Rate']).astype(dtype)
+                    np.subtract(H_now, wake_baseline, out=H_wake)
+                    np.multiply(H_wake, wake_decay, out=H_wake)
+                    np.add(H_wake, wake_baseline, out=H_wake)
+                    np.multiply(H_now, sleep_decay, out=H_sleep)
+                    np.copyto(H_now, np.where(awake_now, H_wake, H_sleep))
+
+                    upper_i = upper[0, i] if shared else upper[bound_index, i]
+                    lower_i = lower[0, i] if shared else lower[bound_index, i]
+                    # Fall asleep where awake and H >= upper, wake up where asleep and H <= lower
+                    np.copyto(switched, np.where(awake_now, H_now >= upper_i, H_now <= lower_i))
+                    np.not_equal(awake_now, switched, out=awake_now)
+
+                if keep_H:
+                    H[:, i] = H_now
+                block[:, i % 8] = awake_now
+                if i % 8 == 7 or i == n_steps - 1:
+                    awake_bits[:, i // 8] = np.packbits(block[:, :i % 8 + 1], axis=1)[:, 0]
+        metrics.count('simulations', n_subjects)
+        metrics.count('steps', n_subjects * n_steps)
+
+        return PopulationSleepData(ts, H, H_now, awake_bits, upper, lower, bound_index, params)
+
+    def simulate_scheduled(self, schedule, ts, sleep_pressure_T0, wake_status_T0=False):
+        # Simulate one run whose parameters follow a schedule.ParameterSchedule on top of self.params.
+        # Bounds and decay factors are computed per segment up front; the loop only reads arrays.
+        compiled = schedule.compile(self.params)
+        ts = np.asarray(ts, dtype=float)
+
+        with metrics.phase('bounds'):
+            upper = compiled.calculate_upper_bound(ts)
+            lower = compiled.calculate_lower_bound(ts)
+            wake_decay, sleep_decay, wake_baseline = compiled.decay_factors(ts)
+
+        H = np.full(len(ts), np.nan)
+        H[0] = sleep_pressure_T0
+        awake = np.full(len(ts), wake_status_T0, dtype=bool)
+
+        sleep_starts = []
+        sleep_ends = []
+        with metrics.phase('integration'):
+            for i in range(1, len(ts)):
+                if awake[i-1]:
+                    H[i] = wake_baseline[i-1] + (H[i-1] - wake_baseline[i-1]) * wake_decay[i-1]
+                else:
+                    H[i] = H[i-1] * sleep_decay[i-1]
+
+                if awake[i-1] and H[i] >= upper[i]:
+                    awake[i] = False
+                    sleep_starts.append(ts[i])
+                elif (not awake[i-1]) and H[i] <= lower[i]:
+                    awake[i] = True
+                    sleep_ends.append(ts[i])
+                else:
+                    awake[i] = awake[i-1]
+        metrics.count('simulations')
+        metrics.count('steps', len(ts))
+        metrics.count('switches', len(sleep_starts) + len(sleep_ends))
+
+        # Add the end of the simulation as the end time of the last sleep period if necessary
+        if len(sleep_starts) > len(sleep_ends):
+            sleep_ends.append(ts[-1])
+
+        sleep_data = SleepData(ts, H, awake, upper, lower, sleep_starts, sleep_ends, compiled.calculate_circadian_rhythm, self.params)
+        sleep_data.schedule = compiled
         return sleep_data
+
+    def _switch_condition(self, t, t0, H0, awake):
+        # Signed distance to the next switch within a bout that starts at t0 with pressure H0.
+        # The switch happens where this first becomes >= 0.
+        if awake:
+            return self.Ha(t - t0, H0) - self.process_c.calculate_upper_bound(t)
+        return self.process_c.calculate_lower_bound(t) - self.process_s.calculate_sleep_pressure(t - t0, H0)
+
+    def _find_switch(self, t0, H0, awake, t_end, scan_step, tolerance):
+        # Find the first time after t0 where the current bout ends, or None if it lasts past t_end.
+        # Scan one circadian period at a time for a sign change, then refine the bracket by bisection.
+        if self._switch_condition(t0, t0, H0, awake) >= 0:
+            return t0
+
+        period = 2 * np.pi / self.params['circadian_frequency']
+        window_start = t0
+        while window_start < t_end:
+            window = np.append(window_start + np.arange(1, int(np.ceil(period / scan_step)) + 1) * scan_step, t_end)
+            window = window[window <= t_end]
+            crossed = np.flatnonzero(self._switch_condition(window, t0, H0, awake) >= 0)
+            if len(crossed) > 0:
+                hi = window[crossed[0]]
+                lo = window[crossed[0] - 1] if crossed[0] > 0 else window_start
+                while hi - lo > tolerance:
+                    mid = 0.5 * (lo + hi)
+                    if self._switch_condition(mid, t0, H0, awake) >= 0:
+                        hi = mid
+                    else:
+                        lo = mid
+                return hi
+            window_start = window[-1]
+        return None
+
+    def simulate_events(self, t_start, t_end, sleep_pressure_T0, wake_status_T0=False, scan_step=0.25, tolerance=1e-9):
+        # Simulate the Borbely model by jumping from one sleep/wake switch to the next.
+        # Within a bout sleep pressure is a closed-form exponential, so only the crossing times
+        # of the upper/lower bounds are searched for. The cost scales with the number of bouts.
+        # scan_step (hours) is the resolution used to bracket a crossing before it is refined to tolerance.
+        bout_starts = [t_start]
+        bout_H0 = [sleep_pressure_T0]
+        bout_awake = [bool(wake_status_T0)]
+
+        while True:
+            t0, H0, awake = bout_starts[-1], bout_H0[-1], bout_awake[-1]
+            t_switch = self._find_switch(t0, H0, awake, t_end, scan_step, tolerance)
+            if t_switch is None:
+                break
+            H_switch = self.Ha(t_switch - t0, H0) if awake else self.process_s.calculate_sleep_pressure(t_switch - t0, H0)
+            bout_starts.append(t_switch)
+            bout_H0.append(H_switch)
+            bout_awake.append(not awake)
+
+        return SleepEvents(self, np.array(bout_starts), np.array(bout_H0), np.array(bout_awake), t_end)
     
 class SleepData:
     # This class encapsulates the sleep data and provides methods for accessing it.
-    def __init__(self, time, H, awake, calculate_upper_bound, calculate_lower_bound, sleep_starts, sleep_ends, calculate_circadian_rhythm):
+    def __init__(self, time, H, awake, calculate_upper_bound, calculate_lower_bound, sleep_starts, sleep_ends, calculate_circadian_rhythm, params=None):
         self.time = time
         self.H = H
         self.awake = awake
@@ -135,23 +604,500 @@ class SleepData:
         self.sleep_starts = sleep_starts
         self.sleep_ends = sleep_ends
         self.calculate_circadian_rhythm = calculate_circadian_rhythm  # Add a reference to the calculate_circadian_rhythm function
+        self.params = params  # The parameters that generated this data, if known
 
 
+    def _sleep_period_indices(self):
+        # Indices into time where sleep periods start and end. Transitions are only counted from the
+        # first awake sample after time[0] onwards, so a sleep period the run begins in is skipped.
+        awake = np.asarray(self.awake, dtype=bool)
+        awake_after_start = np.flatnonzero(awake[1:])
+        if len(awake_after_start) == 0:
+            return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
+        first_wake = awake_after_start[0] + 1
+
+        change = np.flatnonzero(np.diff(awake.view(np.int8))) + 1
+        change = change[change >= first_wake]
+        start_indices = change[~awake[change]]
+        end_indices = change[awake[change]]
+        return start_indices, end_indices
+
     def identify_sleep_periods(self):
         # Identifies the sleep periods.
-        sleep_starts = []
-        sleep_ends = []
-        first_wake = False
-        for i in range(1, len(self.time)):
-            if not first_wake and self.awake[i]:
-                first_wake = True
-            if first_wake:
-                if self.awake[i-1] and not self.awake[i]:
-                    sleep_starts.append(self.time[i])
-                elif not self.awake[i-1] and self.awake[i]:
-                    sleep_ends.append(self.time[i])
-        sleep_periods = list(zip(sleep_starts, sleep_ends))
-        for i, (start, end) in enumerate(sleep_periods):
-            print(f"Sleep period {i+1}: starts at {start}, ends at {end}")
+        with metrics.phase('episode_extraction'):
+            start_indices, end_indices = self._sleep_period_indices()
+            sleep_starts = list(np.asarray(self.time)[start_indices])
+            sleep_ends = list(np.asarray(self.time)[end_indices])
+        if logger.isEnabledFor(logging.DEBUG):
+            for i, (start, end) in enumerate(zip(sleep_starts, sleep_ends)):
+                logger.debug("Sleep period %d: starts at %s, ends at %s", i + 1, start, end)
+        return sleep_starts, sleep_ends
+
+    @property
+    def episodes(self):
+        # Sorted interval index over the sleep periods, built on first access.
+        # A sleep period still open at the end of the run is closed at time[-1].
+        if getattr(self, '_episodes', None) is None:
+            start_indices, end_indices = self._sleep_period_indices()
+            # An end without a start belongs to the sleep period the run began in
+            if len(end_indices) > 0 and (len(start_indices) == 0 or end_indices[0] < start_indices[0]):
+                end_indices = end_indices[1:]
+            if len(start_indices) > len(end_indices):
+                end_indices = np.append(end_indices, len(self.time) - 1)
+            self._episodes = SleepEpisodeIndex(np.asarray(self.time), start_indices, end_indices)
+        return self._episodes
+
+    def save(self, path, dtype=np.float64):
+        # Save to a directory of .npy columns plus meta.json. H, upper and lower are stored as dtype,
+        # awake is bit-packed and the switch times are stored as indices into time.
+        columns = {
+            'time': np.asarray(self.time, dtype=np.float64),
+            'H': np.asarray(self.H, dtype=dtype),
+            'upper': np.asarray(self.upper, dtype=dtype),
+            'lower': np.asarray(self.lower, dtype=dtype),
+            'awake': self.awake.bits if isinstance(self.awake, PackedBoolArray) else np.packbits(np.asarray(self.awake, dtype=bool)),
+        }
+        for name in ('sleep_starts', 'sleep_ends'):
+            times = np.asarray(getattr(self, name), dtype=np.float64)
+            indices = np.clip(np.searchsorted(columns['time'], times), 0, len(columns['time']) - 1)
+            columns[name] = indices
+            # Switch times that are not on the grid (e.g. from SleepEvents.resample) are kept exactly as well
+            if not np.array_equal(columns['time'][indices], times):
+                columns[name + '_times'] = times
+
+        meta = {'format': 'SleepData', 'version': 1, 'length': len(columns['time']), 'dtype': np.dtype(dtype).name, 'params': self.params}
+        _write_columns(path, columns, meta)
+
+    @staticmethod
+    def load(path):
+        # Load data written by save(). All columns are memory-mapped and only read from disk when accessed:
+        # awake stays bit-packed (PackedBoolArray) and the switch times are looked up on access (SwitchTimes).
+        columns, meta = _read_columns(path)
+        time = columns['time']
+        awake = PackedBoolArray(columns['awake'], meta['length'])
+        switch_times = {name: SwitchTimes(time, columns[name], columns.get(name + '_times')) for name in ('sleep_starts', 'sleep_ends')}
+
+        params = meta['params']
+        calculate_circadian_rhythm = None
+        if params is not None:
+            calculate_circadian_rhythm = ProcessC(params['circadian_frequency'], params['circadian_phase_shift'], params['circadian_amplitude'], params['UpperBound_Sleep_Pressure'], params['LowerBound_Sleep_Pressure']).calculate_circadian_rhythm
+
+        return SleepData(time, columns['H'], awake, columns['upper'], columns['lower'], switch_times['sleep_starts'], switch_times['sleep_ends'], calculate_circadian_rhythm, params)
+
+class SleepEpisodeIndex:
+    # This class is a sorted, non-overlapping interval index over sleep episodes.
+    # Episode k covers [starts[k], ends[k]) and spans time[start_indices[k]:end_indices[k]].
+    # Lookups use binary search, so they cost O(log n) in the number of episodes.
+    def __init__(self, time, start_indices, end_indices):
+        self.start_indices = start_indices
+        self.end_indices = end_indices
+        self.starts = time[start_indices]
+        self.ends = time[end_indices]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, k):
+        # Return the (start, end) times of episode k.
+        return self.starts[k], self.ends[k]
+
+    @property
+    def durations(self):
+        return self.ends - self.starts
+
+    def episode_at(self, t):
+        # Index of the episode containing each time in t, or -1 where awake. Accepts scalars or arrays.
+        k = np.searchsorted(self.starts, t, side='right') - 1
+        inside = (k >= 0) & (t < self.ends[np.clip(k, 0, None)]) if len(self) > 0 else np.zeros(np.shape(k), dtype=bool)
+        return np.where(inside, k, -1)
+
+    def is_asleep(self, t):
+        return self.episode_at(t) >= 0
+
+    def overlapping(self, t0, t1):
+        # Indices of the episodes that overlap the interval [t0, t1].
+        first = np.searchsorted(self.ends, t0, side='right')
+        last = np.searchsorted(self.starts, t1, side='right')
+        return np.arange(first, max(first, last))
+
+class PackedBoolArray(np.lib.mixins.NDArrayOperatorsMixin):
+    # This class is a read-only bool array of shape (T,) or (N, T) kept bit-packed along the last axis,
+    # e.g. a memory-mapped awake column. Indexing unpacks only the rows, and for a contiguous slice of
+    # time only the bytes, that are asked for; operators and NumPy functions unpack the whole array.
+    def __init__(self, bits, length):
+        self.bits = bits
+        self.length = length
+
+    @property
+    def shape(self):
+        return self.bits.shape[:-1] + (self.length,)
+
+    @property
+    def ndim(self):
+        return self.bits.ndim
+
+    dtype = np.dtype(bool)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if self.ndim == 1:
+            return self._unpack(self.bits, key)
+        rows, columns = (tuple(key) + (slice(None),))[:2] if isinstance(key, tuple) else (key, slice(None))
+        return self._unpack(self.bits[rows], columns)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _unpack(self, bits, columns):
+        if isinstance(columns, slice) and columns.step in (None, 1):
+            start, stop, _ = columns.indices(self.length)
+            stop = max(start, stop)
+            first = start // 8
+            unpacked = np.unpackbits(np.asarray(bits[..., first:(stop + 7) // 8]), axis=-1)
+            return unpacked[..., start - 8 * first:stop - 8 * first].view(bool)
+        return np.unpackbits(np.asarray(bits), axis=-1, count=self.length).view(bool)[..., columns]
+
+    def __array__(self, dtype=None, copy=None):
+        awake = self._unpack(self.bits, slice(None))
+        return awake if dtype is None else awake.astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple(np.asarray(x) if isinstance(x, PackedBoolArray) else x for x in inputs)
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+class SwitchTimes(Sequence):
+    # This class is a read-only sequence of switch times stored as indices into time (or, for times off the
+    # grid, as the times themselves), looked up on access instead of being copied into a list on load.
+    def __init__(self, time, indices, times=None):
+        self.time = time
+        self.indices = indices
+        self.times = times
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return SwitchTimes(self.time, self.indices[k], None if self.times is None else self.times[k])
+        k = range(len(self))[k]
+        return self.time[self.indices[k]] if self.times is None else self.times[k]
+
+    def __array__(self, dtype=None, copy=None):
+        times = np.asarray(self.time[np.asarray(self.indices)] if self.times is None else self.times)
+        return times if dtype is None else times.astype(dtype)
+
+    def tolist(self):
+        return np.asarray(self).tolist()
+
+class SwitchTimeRows(Sequence):
+    # This class holds the ragged switch times of a batch as flat indices with (N + 1,) offsets;
+    # row i is a SwitchTimes over indices[offsets[i]:offsets[i+1]].
+    def __init__(self, time, indices, offsets):
+        self.time = time
+        self.indices = indices
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(len(self))[i]]
+        i = range(len(self))[i]
+        return SwitchTimes(self.time, self.indices[self.offsets[i]:self.offsets[i + 1]])
+
+def _json_default(value):
+    # Convert NumPy values found in parameter dicts to plain Python for json.
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value.item()
+
+def _write_columns(path, columns, meta):
+    # Write each column as its own .npy file next to a meta.json that lists them.
+    os.makedirs(path, exist_ok=True)
+    for name, column in columns.items():
+        np.save(os.path.join(path, name + '.npy'), column)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({**meta, 'columns': list(columns)}, f, indent=2, default=_json_default)
+
+def _read_columns(path):
+    # Open the columns written by _write_columns as read-only memory maps.
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in meta['columns']}
+    return columns, meta
+
+class BatchSleepData:
+    # This class holds the (N, T) results of BorbelyModel.simulate_batch, one row per subject.
+    def __init__(self, time, H, awake, upper, lower, params):
+        self.time = time
+        self.H = H
+        self.awake = awake
+        self.upper = upper
+        self.lower = lower
+        self.params = params
+        with metrics.phase('episode_extraction'):
+            self.sleep_starts, self.sleep_ends = self._switch_times()
+        metrics.count('switches', sum(map(len, self.sleep_starts)) + sum(map(len, self.sleep_ends)))
+
+    def __len__(self):
+        return self.H.shape[0]
+
+    def __getitem__(self, i):
+        # Return subject i as a SleepData instance, as simulate() would have produced it.
+        process_c = ProcessC(self.params['circadian_frequency'][i], self.params['circadian_phase_shift'][i], self.params['circadian_amplitude'][i], self.params['UpperBound_Sleep_Pressure'][i], self.params['LowerBound_Sleep_Pressure'][i])
+        return SleepData(self.time, self.H[i], self.awake[i], self.upper[i], self.lower[i], self.sleep_starts[i], self.sleep_ends[i], process_c.calculate_circadian_rhythm, {key: values[i] for key, values in self.params.items()})
+
+    def save(self, path, dtype=np.float64):
+        # Save in the same column layout as SleepData.save, with (N, T) columns, one row per subject.
+        # Parameters are stored as (N,) columns and the ragged switch indices flat with (N + 1,) offsets.
+        columns = {
+            'time': np.asarray(self.time, dtype=np.float64),
+            'H': np.asarray(self.H, dtype=dtype),
+            'upper': np.asarray(self.upper, dtype=dtype),
+            'lower': np.asarray(self.lower, dtype=dtype),
+            'awake': self.awake.bits if isinstance(self.awake, PackedBoolArray) else np.packbits(self.awake, axis=-1),
+        }
+        for name in ('sleep_starts', 'sleep_ends'):
+            switch_times = getattr(self, name)
+            columns[name] = np.searchsorted(columns['time'], np.array([t for times in switch_times for t in times], dtype=np.float64))
+            columns[name + '_offsets'] = np.concatenate([[0], np.cumsum([len(times) for times in switch_times])]).astype(np.int64)
+        for key, values in self.params.items():
+            columns['param_' + key] = values
+
+        meta = {'format': 'BatchSleepData', 'version': 1, 'length': len(columns['time']), 'dtype': np.dtype(dtype).name, 'params': list(self.params)}
+        _write_columns(path, columns, meta)
+
+    @staticmethod
+    def load(path):
+        # Load data written by save(), memory-mapping every column. awake stays bit-packed (PackedBoolArray),
+        # so batch[i] unpacks only row i, and the switch times of a row are looked up when it is accessed.
+        columns, meta = _read_columns(path)
+        batch = BatchSleepData.__new__(BatchSleepData)
+        batch.time = columns['time']
+        batch.H = columns['H']
+        batch.awake = PackedBoolArray(columns['awake'], meta['length'])
+        batch.upper = columns['upper']
+        batch.lower = columns['lower']
+        batch.params = {key: columns['param_' + key] for key in meta['params']}
+        for name in ('sleep_starts', 'sleep_ends'):
+            setattr(batch, name, SwitchTimeRows(batch.time, columns[name], columns[name + '_offsets']))
+        return batch
+
+    def _switch_times(self):
+        # Collect the switch times of every subject from the transitions in the awake array.
+        falls_asleep = self.awake[:, :-1] & ~self.awake[:, 1:]
+        wakes_up = ~self.awake[:, :-1] & self.awake[:, 1:]
+
+        sleep_starts = [list(self.time[1:][row]) for row in falls_asleep]
+        sleep_ends = [list(self.time[1:][row]) for row in wakes_up]
+
+        # Add the end of the simulation as the end time of the last sleep period if necessary
+        for starts, ends in zip(sleep_starts, sleep_ends):
+            if len(starts) > len(ends):
+                ends.append(self.time[-1])
+
+        return sleep_starts, sleep_ends
+
+
+class SleepEvents:
+    # This class holds the exact sleep/wake switch times found by BorbelyModel.simulate_events.
+    # Bout k starts at bout_starts[k] with sleep pressure bout_H0[k] and wake state bout_awake[k].
+    def __init__(self, model, bout_starts, bout_H0, bout_awake, t_end):
+        self.model = model
+        self.bout_starts = bout_starts
+        self.bout_H0 = bout_H0
+        self.bout_awake = bout_awake
+        self.t_end = t_end
+
+    @property
+    def sleep_starts(self):
+        return list(self.bout_starts[1:][~self.bout_awake[1:]])
+
+    @property
+    def sleep_ends(self):
+        sleep_ends = list(self.bout_starts[1:][self.bout_awake[1:]])
+        # Add the end of the simulation as the end time of the last sleep period if necessary
+        if len(self.sleep_starts) > len(sleep_ends):
+            sleep_ends.append(self.t_end)
+        return sleep_ends
+
+    def bout_index(self, t):
+        # Index of the bout that contains each time in t.
+        return np.searchsorted(self.bout_starts, t, side='right') - 1
+
+    def sleep_pressure(self, t):
+        # Evaluate sleep pressure at arbitrary times from the closed-form solution of each bout.
+        t = np.asarray(t, dtype=float)
+        k = np.clip(self.bout_index(t), 0, None)
+        elapsed = t - self.bout_starts[k]
+        H0 = self.bout_H0[k]
+        return np.where(self.bout_awake[k], self.model.Ha(elapsed, H0), self.model.process_s.calculate_sleep_pressure(elapsed, H0))
+
+    def resample(self, ts):
+        # Evaluate the trajectory on any time grid and return it as SleepData.
+        # The switch times are the exact ones inside [ts[0], ts[-1]], not snapped to the grid.
+        ts = np.asarray(ts, dtype=float)
+        H = self.sleep_pressure(ts)
+        awake = self.bout_awake[np.clip(self.bout_index(ts), 0, None)]
+        upper = self.model.process_c.calculate_upper_bound(ts)
+        lower = self.model.process_c.calculate_lower_bound(ts)
+
+        switch_times = self.bout_starts[1:]
+        in_range = (switch_times > ts[0]) & (switch_times <= ts[-1])
+        sleep_starts = list(switch_times[in_range & ~self.bout_awake[1:]])
+        sleep_ends = list(switch_times[in_range & self.bout_awake[1:]])
+        if len(sleep_starts) > len(sleep_ends):
+            sleep_ends.append(ts[-1])
+
+        return SleepData(ts, H, awake, upper, lower, sleep_starts, sleep_ends, self.model.process_c.calculate_circadian_rhythm, self.model.params)
+
+class Checkpoint:
+    # This class holds the integrator state at step index of a run: time t, sleep pressure H, wake state,
+    # the switch times up to t and the parameters used so far. BorbelyModel.resume continues from it.
+    def __init__(self, t, index, H, awake, sleep_starts, sleep_ends, params):
+        self.t = float(t)
+        self.index = int(index)
+        self.H = float(H)
+        self.awake = bool(awake)
+        self.sleep_starts = [float(t) for t in sleep_starts]
+        self.sleep_ends = [float(t) for t in sleep_ends]
+        self.params = params
+
+    @staticmethod
+    def from_sleep_data(sleep_data, index):
+        # The state of a finished run at any step, read off its arrays without re-simulating.
+        time = np.asarray(sleep_data.time)
+        awake = np.asarray(sleep_data.awake)
+        switched = awake[:index] != awake[1:index + 1]
+        sleep_starts = time[1:index + 1][switched & awake[:index]]
+        sleep_ends = time[1:index + 1][switched & ~awake[:index]]
+        return Checkpoint(time[index], index, sleep_data.H[index], awake[index], sleep_starts, sleep_ends, sleep_data.params)
+
+    def save(self, path):
+        # Save as JSON; floats are written with repr, so a loaded checkpoint resumes bit-for-bit.
+        with open(path, 'w') as f:
+            json.dump(self.__dict__, f, default=_json_default)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            state = json.load(f)
+        return Checkpoint(state['t'], state['index'], state['H'], state['awake'], state['sleep_starts'], state['sleep_ends'], state['params'])
+
+class PopulationSleepData:
+    # This class holds the result of BorbelyModel.simulate_population without materializing per-subject copies:
+    # H is (N, T) in the reduced dtype (None with keep_H=False, final_H is always kept), the wake state is
+    # bit-packed to (N, ceil(T / 8)) bytes, and upper/lower are (U, T) arrays for the U distinct circadian
+    # parameter sets, with bound_index mapping each subject to its row. The circadian curve is not stored;
+    # SleepData.calculate_circadian_rhythm of a subject recomputes it from that subject's parameters.
+    def __init__(self, time, H, final_H, awake_bits, upper, lower, bound_index, params):
+        self.time = time
+        self.H = H
+        self.final_H = final_H
+        self.awake_bits = awake_bits
+        self.upper_shared = upper
+        self.lower_shared = lower
+        self.bound_index = bound_index
+        self.params = params
+
+    def __len__(self):
+        return len(self.bound_index)
+
+    @property
+    def nbytes(self):
+        arrays = [self.final_H, self.awake_bits, self.upper_shared, self.lower_shared, self.bound_index] + list(self.params.values())
+        return sum(array.nbytes for array in arrays) + (self.H.nbytes if self.H is not None else 0)
+
+    def awake(self, rows=slice(None)):
+        # Unpack the wake state of some subjects (an index, slice or index array) to bool.
+        bits = self.awake_bits[rows]
+        return np.unpackbits(bits, axis=-1, count=len(self.time)).view(bool)
+
+    def switch_times(self, i):
+        # (sleep_starts, sleep_ends) of subject i, with an open sleep period closed at time[-1] as in simulate().
+        awake = self.awake(i)
+        sleep_starts = list(self.time[1:][awake[:-1] & ~awake[1:]])
+        sleep_ends = list(self.time[1:][~awake[:-1] & awake[1:]])
+        if len(sleep_starts) > len(sleep_ends):
+            sleep_ends.append(self.time[-1])
         return sleep_starts, sleep_ends
-    
\ No newline at end of file
+
+    def __getitem__(self, i):
+        # Return subject i as a float64 SleepData.
+        if self.H is None:
+            raise ValueError("H was not kept (keep_H=False)")
+        params = {key: values[i] for key, values in self.params.items()}
+        process_c = ProcessC(*(params[key] for key in CIRCADIAN_KEYS))
+        sleep_starts, sleep_ends = self.switch_times(i)
+        k = self.bound_index[i]
+        return SleepData(self.time, self.H[i].astype(float), self.awake(i), self.upper_shared[k].astype(float), self.lower_shared[k].astype(float),
+                         sleep_starts, sleep_ends, process_c.calculate_circadian_rhythm, params)
+
+    def subjects(self, start, stop):
+        # Subjects start..stop-1 as a float64 BatchSleepData, e.g. to feed compute_sleep_metrics chunk by chunk.
+        if self.H is None:
+            raise ValueError("H was not kept (keep_H=False)")
+        rows = slice(start, stop)
+        index = self.bound_index[rows]
+        return BatchSleepData(self.time, self.H[rows].astype(float), self.awake(rows), self.upper_shared[index].astype(float),
+                              self.lower_shared[index].astype(float), {key: values[rows] for key, values in self.params.items()})
+
+def validate_population(model, params_table, ts, H0, awake0=False, dtype=np.float32):
+    # Compare simulate_population in dtype against the float64 simulate_batch path.
+    #
+    # Error bound: every step rounds H to dtype a few times, adding at most about 2 * eps * max(H, B) (eps the
+    # machine epsilon of dtype, B the wake baseline). Each step also multiplies the earlier error by a decay
+    # factor q < 1, so while both paths are in the same state the error stays below
+    #     H_error_bound = 2 * eps * max(H0, B) / (1 - q_max)
+    # with q_max the largest per-step decay factor, i.e. that of the smallest time step and the slowest rate
+    # (q_max is about 0.9945 for dt = 0.1 h and the default rates, giving a bound of about 4e-5 for float32).
+    # A switch can therefore only come out differently where H passes within H_error_bound of a bound. It then
+    # moves by one time step, after which the two runs are shifted against each other. Entrained runs pull the
+    # shift back, but in weakly entrained (free-running) regimes it can grow by further steps over later days.
+    # Returns the measured errors next to the bound.
+    ts = np.asarray(ts, dtype=float)
+    reference = model.simulate_batch(params_table, ts, H0, awake0)
+    lean = model.simulate_population(params_table, ts, H0, awake0, dtype)
+    awake = lean.awake()
+
+    # Compare H only up to each subject's first differing wake state
+    mismatch = awake != reference.awake
+    first_mismatch = np.where(mismatch.any(axis=1), mismatch.argmax(axis=1), len(ts))
+    same_state = np.arange(len(ts)) < first_mismatch[:, None]
+    H_error = np.abs(lean.H.astype(float) - reference.H)
+
+    switch_shifts = []
+    for i in range(len(lean)):
+        sleep_starts, sleep_ends = lean.switch_times(i)
+        if len(sleep_starts) == len(reference.sleep_starts[i]) and len(sleep_ends) == len(reference.sleep_ends[i]):
+            switch_shifts.append(np.abs(np.subtract(sleep_starts + sleep_ends, reference.sleep_starts[i] + reference.sleep_ends[i])).max(initial=0.0))
+
+    dts = np.diff(ts)
+    q_max = np.exp(-dts.min() / np.maximum(reference.params['Wake_Decay_Rate'], reference.params['Sleep_Decay_Rate'])).max()
+    scale = max(np.max(np.abs(H0)), reference.params['Wake_Baseline_Pressure'].max())
+    return {
+        'H_error_bound': 2 * np.finfo(dtype).eps * scale / (1 - q_max),
+        'max_H_error_same_state': H_error[same_state].max(),
+        'max_H_error': H_error.max(),
+        'mismatched_step_fraction': mismatch.mean(),
+        'subjects_with_different_switches': int(len(lean) - len(switch_shifts) + sum(shift > 0 for shift in switch_shifts)),
+        'max_switch_shift': max(switch_shifts, default=0.0),
+        'max_time_step': dts.max(),
+        'bytes_float64': reference.H.nbytes + reference.awake.nbytes + reference.upper.nbytes + reference.lower.nbytes,
+        'bytes_lean': lean.nbytes,
+    }
+
+def check_population(model, params_table, ts, H0, awake0=False):
+    # Assert the guarantees of simulate_population: float64 reproduces simulate_batch bit for bit, and
+    # float32 stays within H_error_bound while in the same state. Raises AssertionError otherwise.
+    exact = validate_population(model, params_table, ts, H0, awake0, np.float64)
+    if exact['max_H_error'] != 0 or exact['mismatched_step_fraction'] != 0:
+        raise AssertionError(f"float64 population run differs from simulate_batch: {exact}")
+    lean = validate_population(model, params_table, ts, H0, awake0, np.float32)
+    if not lean['max_H_error_same_state'] <= lean['H_error_bound']:
+        raise AssertionError(f"float32 sleep pressure error {lean['max_H_error_same_state']} exceeds the bound {lean['H_error_bound']}")
+    return lean
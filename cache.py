@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from borbely import SleepData
+from instrumentation import metrics
+
+class SimulationCache:
+    # This class memoizes BorbelyModel.simulate, keyed by a stable hash of (params, ts, sleep_pressure_T0, wake_status_T0).
+    # Results live in a bounded in-memory LRU and, if cache_dir is given, in .npz files on disk whose
+    # total size is kept under max_disk_bytes by evicting the least recently used files.
+    def __init__(self, max_entries=128, cache_dir=None, max_disk_bytes=1 << 30):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(params, ts, sleep_pressure_T0, wake_status_T0):
+        # Hash the inputs of a simulation. Floats are written with repr, which round-trips exactly.
+        digest = hashlib.sha256()
+        digest.update(json.dumps(params, sort_keys=True, default=float).encode())
+        ts = np.ascontiguousarray(ts, dtype=float)
+        digest.update(str(ts.shape).encode())
+        digest.update(ts.tobytes())
+        digest.update(repr((float(sleep_pressure_T0), bool(wake_status_T0))).encode())
+        return digest.hexdigest()
+
+    def simulate(self, model, ts, sleep_pressure_T0, wake_status_T0=False):
+        # Return model.simulate(ts, sleep_pressure_T0, wake_status_T0), computing it only on a miss.
+        # The arrays of a cached result are shared between callers and therefore read-only.
+        key = self.key(model.params, ts, sleep_pressure_T0, wake_status_T0)
+
+        if key in self.memory:
+            self.hits += 1
+            metrics.count('cache_hits')
+            self.memory.move_to_end(key)
+            arrays = self.memory[key]
+            if self.cache_dir is not None and os.path.exists(self._path(key)):
+                os.utime(self._path(key))
+        else:
+            arrays = self._load(key)
+            if arrays is not None:
+                self.disk_hits += 1
+                metrics.count('cache_disk_hits')
+            else:
+                self.misses += 1
+                metrics.count('cache_misses')
+                sleep_data = model.simulate(ts, sleep_pressure_T0, wake_status_T0)
+                arrays = {
+                    'time': sleep_data.time, 'H': sleep_data.H, 'awake': sleep_data.awake,
+                    'upper': sleep_data.upper, 'lower': sleep_data.lower,
+                    'sleep_starts': np.array(sleep_data.sleep_starts, dtype=float),
+                    'sleep_ends': np.array(sleep_data.sleep_ends, dtype=float),
+                }
+                for array in arrays.values():
+                    array.flags.writeable = False
+                self._save(key, arrays)
+            self._remember(key, arrays)
+
+        return SleepData(arrays['time'], arrays['H'], arrays['awake'], arrays['upper'], arrays['lower'],
+                         list(arrays['sleep_starts']), list(arrays['sleep_ends']), model.process_c.calculate_circadian_rhythm, model.params)
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'entries': len(self.memory)}
+
+    def clear(self):
+        # Empty the in-memory tier. Files on disk are kept.
+        self.memory.clear()
+
+    def _remember(self, key, arrays):
+        self.memory[key] = arrays
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def _load(self, key):
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+        os.utime(self._path(key))  # Mark as recently used for eviction
+        with np.load(self._path(key)) as stored:
+            arrays = {name: stored[name] for name in stored.files}
+        for array in arrays.values():
+            array.flags.writeable = False
+        return arrays
+
+    def _save(self, key, arrays):
+        if self.cache_dir is None:
+            return
+        # Write to a temporary file in the same directory and rename it into place, so a crash or a concurrent
+        # reader never sees a partial entry. The name is unique per writer and does not end in .npz.
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=key + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._evict_disk()
+
+    def _evict_disk(self):
+        # Delete the least recently used files until the cache directory fits in max_disk_bytes.
+        entries = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.npz')]
+        entries = sorted(entries, key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in entries)
+        while entries and total > self.max_disk_bytes:
+            path = entries.pop(0)
+            total -= os.path.getsize(path)
+            os.remove(path)
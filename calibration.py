@@ -0,0 +1,152 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from borbely import BorbelyModel
+
+# Parameters fitted by default, with the ranges the search is confined to
+default_bounds = {
+    'Sleep_Decay_Rate': (1.0, 10.0),
+    'Wake_Decay_Rate': (8.0, 30.0),
+    'circadian_amplitude': (0.0, 0.5),
+    'circadian_phase_shift': (-np.pi, np.pi),
+    'UpperBound_Sleep_Pressure': (0.4, 0.8),
+    'LowerBound_Sleep_Pressure': (0.05, 0.35),
+}
+
+class SleepObservations:
+    # This class holds what was observed for one subject on the simulation grid ts: a wake mask,
+    # sleep onset/offset times (hours), or both. Missing pieces are simply not scored.
+    def __init__(self, ts, awake=None, sleep_onsets=None, sleep_offsets=None, sleep_pressure_T0=0.1, wake_status_T0=True):
+        self.ts = np.asarray(ts, dtype=float)
+        self.awake = None if awake is None else np.asarray(awake, dtype=bool)
+        self.sleep_onsets = None if sleep_onsets is None else np.asarray(sleep_onsets, dtype=float)
+        self.sleep_offsets = None if sleep_offsets is None else np.asarray(sleep_offsets, dtype=float)
+        self.sleep_pressure_T0 = sleep_pressure_T0
+        self.wake_status_T0 = wake_status_T0
+
+    def fingerprint(self):
+        # Digest of everything that affects a score, so cached losses are only reused for the same observations.
+        digest = hashlib.sha1(repr((self.sleep_pressure_T0, self.wake_status_T0)).encode())
+        for array in (self.ts, self.awake, self.sleep_onsets, self.sleep_offsets):
+            digest.update(b'-' if array is None else repr(array.shape).encode() + array.tobytes())
+        return digest.hexdigest()
+
+def _timing_error(simulated, observed, missing_penalty):
+    # Mean absolute distance (hours) from each observed switch time to the nearest simulated one.
+    if len(simulated) == 0:
+        return missing_penalty
+    idx = np.clip(np.searchsorted(simulated, observed), 1, max(len(simulated) - 1, 1))
+    nearest = np.minimum(np.abs(observed - simulated[idx - 1]), np.abs(observed - simulated[np.minimum(idx, len(simulated) - 1)]))
+    return nearest.mean()
+
+def score_candidates(model, candidates, observations, mask_weight=1.0, timing_weight=1.0, missing_penalty=24.0):
+    # Loss of every candidate parameter set (dict of (P,) arrays) against the observations, shape (P,).
+    # The wake-mask term is the fraction of mismatched samples, the timing term the mean onset/offset error in hours.
+    batch = model.simulate_batch(candidates, observations.ts, observations.sleep_pressure_T0, observations.wake_status_T0)
+    loss = np.zeros(len(batch))
+
+    if observations.awake is not None:
+        loss += mask_weight * (batch.awake != observations.awake).mean(axis=1)
+
+    for i in range(len(batch)):
+        if observations.sleep_onsets is not None and len(observations.sleep_onsets) > 0:
+            loss[i] += timing_weight * _timing_error(np.array(batch.sleep_starts[i]), observations.sleep_onsets, missing_penalty)
+        if observations.sleep_offsets is not None and len(observations.sleep_offsets) > 0:
+            loss[i] += timing_weight * _timing_error(np.array(batch.sleep_ends[i]), observations.sleep_offsets, missing_penalty)
+
+    return loss
+
+class CalibrationResult:
+    # This class holds the outcome of a fit, including the search distribution so a later fit can warm start from it.
+    def __init__(self, params, loss, mean, sigma, n_evaluations, history):
+        self.params = params
+        self.loss = loss
+        self.mean = mean
+        self.sigma = sigma
+        self.n_evaluations = n_evaluations
+        self.history = history
+
+class Calibrator:
+    # This class fits Borbely parameters to observations with a derivative-free cross-entropy search:
+    # each iteration samples a population of candidates from a diagonal Gaussian in the unit-scaled
+    # parameter box, scores all of them in one simulate_batch call, and refits the Gaussian to the elite.
+    # Scores are cached per observations and score options, so candidates that repeat (after clipping to
+    # the bounds) are not simulated again, and one Calibrator can be reused across subjects. The cache is
+    # an LRU of at most max_cache_entries scores.
+    def __init__(self, base_params=None, bounds=None, population_size=32, elite_fraction=0.25, seed=None, max_cache_entries=100_000):
+        self.model = BorbelyModel(base_params)
+        self.bounds = default_bounds if bounds is None else bounds
+        self.names = list(self.bounds)
+        self.low = np.array([self.bounds[name][0] for name in self.names], dtype=float)
+        self.high = np.array([self.bounds[name][1] for name in self.names], dtype=float)
+        self.population_size = population_size
+        self.n_elite = max(2, int(round(elite_fraction * population_size)))
+        self.rng = np.random.default_rng(seed)
+        self.max_cache_entries = max_cache_entries
+        self.cache = OrderedDict()
+
+    def _to_unit(self, params):
+        # Inverse of _to_params for one params dict, clipped to the unit box, shape (D,).
+        values = np.array([params[name] for name in self.names], dtype=float)
+        return np.clip((values - self.low) / (self.high - self.low), 0, 1)
+
+    def _to_params(self, unit):
+        # Map points of the unit box, shape (P, D), to a dict of (P,) parameter arrays.
+        values = self.low + unit * (self.high - self.low)
+        return {name: values[:, j] for j, name in enumerate(self.names)}
+
+    def _evaluate(self, unit, observations, **score_options):
+        # Score the rows of unit, simulating only those not seen before for these observations and options.
+        context = (observations.fingerprint(), tuple(sorted(score_options.items())))
+        keys = [(context, tuple(np.round(row, 12))) for row in unit]
+        scores = {key: self.cache[key] for key in keys if key in self.cache}
+        for key in scores:
+            self.cache.move_to_end(key)
+        todo = [i for i, key in enumerate(keys) if key not in scores]
+        if todo:
+            losses = score_candidates(self.model, self._to_params(unit[todo]), observations, **score_options)
+            for i, loss in zip(todo, losses):
+                scores[keys[i]] = self.cache[keys[i]] = loss
+            while len(self.cache) > self.max_cache_entries:
+                self.cache.popitem(last=False)
+        return np.array([scores[key] for key in keys]), len(todo)
+
+    def fit(self, observations, max_iterations=40, tolerance=1e-3, warm_start=None, **score_options):
+        # Fit the parameters to observations. warm_start may be a previous CalibrationResult, or a params
+        # dict to start the search around. score_options are passed on to score_candidates.
+        # The previous best point is put into the first population (as best_unit), so a warm-started fit
+        # never ends worse than it. It is scored again because the observations may have changed.
+        if isinstance(warm_start, CalibrationResult):
+            mean, sigma = warm_start.mean.copy(), np.maximum(warm_start.sigma, 0.05)
+            best_unit = self._to_unit(warm_start.params)
+        elif warm_start is not None:
+            mean = self._to_unit(warm_start)
+            sigma = np.full(len(self.names), 0.1)
+            best_unit = mean
+        else:
+            mean, sigma = np.full(len(self.names), 0.5), np.full(len(self.names), 0.3)
+            best_unit = mean
+        best_loss = np.inf
+        n_evaluations = 0
+        history = []
+        for _ in range(max_iterations):
+            unit = np.clip(mean + sigma * self.rng.standard_normal((self.population_size, len(self.names))), 0, 1)
+            unit[0] = best_unit  # Keep the best point found so far in the population
+            losses, n_new = self._evaluate(unit, observations, **score_options)
+            n_evaluations += n_new
+
+            order = np.argsort(losses)
+            if losses[order[0]] < best_loss:
+                best_unit, best_loss = unit[order[0]], losses[order[0]]
+            history.append(best_loss)
+
+            elite = unit[order[:self.n_elite]]
+            mean = elite.mean(axis=0)
+            sigma = 0.7 * sigma + 0.3 * elite.std(axis=0)
+            if sigma.max() < tolerance:
+                break
+
+        params = {**self.model.params, **{name: values[0] for name, values in self._to_params(best_unit[None, :]).items()}}
+        return CalibrationResult(params, best_loss, mean, sigma, n_evaluations, history)
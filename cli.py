@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+import sys
+
+# Command-line entry point: python cli.py {simulate,sweep,stats,plot} ...
+# Only argparse/json are imported up front. NumPy and the model are imported by the subcommands,
+# and matplotlib only by 'plot', so short batch jobs on headless workers do not pay for plotting.
+
+def load_params(path=None):
+    # Return (base params, configurations) from a config.py-style Python file (default_params and, optionally,
+    # configurations) or a JSON file holding either a params dict or {"default_params": ..., "configurations": [...]}.
+    # Without a path the repository's config.py is used.
+    if path is None:
+        from config import configurations, default_params
+        return dict(default_params), list(configurations)
+
+    if path.endswith('.json'):
+        with open(path) as f:
+            loaded = json.load(f)
+        if 'default_params' not in loaded and 'configurations' not in loaded:
+            loaded = {'default_params': loaded}
+    else:
+        import runpy
+        loaded = runpy.run_path(path)
+
+    from config import default_params
+    return {**default_params, **loaded.get('default_params', {})}, list(loaded.get('configurations', []))
+
+def _parse_value(text):
+    # Values of --set and --grid are JSON (numbers, true/false) and fall back to plain strings.
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def _parse_assignment(text):
+    name, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got {text!r}")
+    return name, value
+
+def _selected_runs(args):
+    # The parameter sets to simulate: the configurations picked with --config (all of them for 'all'),
+    # or the base parameters alone, each with the --set overrides applied on top.
+    base_params, configurations = load_params(args.params)
+    overrides = {name: _parse_value(value) for name, value in args.set}
+    if not args.config:
+        runs = [{'simulation_key': 'default', 'title': 'Default Condition'}]
+    elif 'all' in args.config:
+        runs = configurations
+    else:
+        by_key = {config['simulation_key']: config for config in configurations}
+        missing = [key for key in args.config if key not in by_key]
+        if missing:
+            raise SystemExit(f"unknown configuration(s): {', '.join(missing)}")
+        runs = [by_key[key] for key in args.config]
+    return base_params, [{**config, **overrides} for config in runs]
+
+def _time_base(args):
+    import numpy as np
+    return np.arange(args.start, args.start + args.hours, args.dt)
+
+def _simulate_runs(args):
+    from borbely import BorbelyModel
+    base_params, runs = _selected_runs(args)
+    ts = _time_base(args)
+    batch = BorbelyModel(base_params).simulate_batch(runs, ts, args.H0, not args.asleep)
+    return runs, ts, batch
+
+def _write_json(data, path=None):
+    def default(value):
+        return value.tolist() if hasattr(value, 'tolist') else str(value)
+    if path is None:
+        json.dump(data, sys.stdout, indent=2, default=default)
+        sys.stdout.write('\n')
+    else:
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2, default=default)
+
+def cmd_simulate(args):
+    # Print the sleep onsets/offsets of every run; with --output also save each run as columnar SleepData.
+    runs, ts, batch = _simulate_runs(args)
+    summary = {}
+    for i, config in enumerate(runs):
+        key = config['simulation_key']
+        summary[key] = {'sleep_starts': batch.sleep_starts[i], 'sleep_ends': batch.sleep_ends[i]}
+        if args.output:
+            batch[i].save(os.path.join(args.output, key))
+    _write_json(summary)
+
+def cmd_stats(args):
+    # Sleep metrics of saved simulations (--input) or of the selected runs.
+    from sleep_metrics import compute_sleep_metrics
+    if args.input:
+        from borbely import SleepData
+        results = {path: compute_sleep_metrics(SleepData.load(path)) for path in args.input}
+    else:
+        runs, ts, batch = _simulate_runs(args)
+        metrics = compute_sleep_metrics(batch)
+        results = {config['simulation_key']: {name: values[i] for name, values in metrics.items()} for i, config in enumerate(runs)}
+    _write_json(results, args.output)
+
+def cmd_sweep(args):
+    # Sweep the cartesian product of the --grid values and write the result table as CSV.
+    from functools import partial
+    from sweep import ParameterSweep, parameter_grid, print_progress
+    base_params, _ = load_params(args.params)
+    base_params.update({name: _parse_value(value) for name, value in args.set})
+    grid = {name: [_parse_value(value) for value in values.split(',')] for name, values in args.grid}
+    sweep = ParameterSweep(parameter_grid(grid), base_params, args.chunk_size)
+    # Progress goes to stderr so it cannot end up in the CSV written to stdout
+    progress = partial(print_progress, file=sys.stderr) if args.progress else None
+    result = sweep.run(_time_base(args), args.H0, not args.asleep, args.processes, progress)
+
+    names = list(result.columns)
+    f = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        f.write(','.join(names) + '\n')
+        for i in range(len(result)):
+            f.write(','.join(str(result[name][i]) for name in names) + '\n')
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+def cmd_plot(args):
+    # With --output-dir render one file per run headlessly; otherwise open the interactive six-panel figure.
+    base_params, runs = _selected_runs(args)
+    # Both plotting paths simulate on top of config.default_params, so carry the base params in each run
+    runs = [{**base_params, **config} for config in runs]
+    if args.output_dir:
+        import matplotlib
+        matplotlib.use('Agg')
+        from visualizations import render_configurations
+        for path in render_configurations(runs, _time_base(args), args.H0, not args.asleep, args.output_dir, args.format, args.processes):
+            print(path)
+    else:
+        from borbely import BorbelyModel
+        from visualizations import plot_configurations
+        plot_configurations(runs, BorbelyModel(base_params), _time_base(args), args.H0, not args.asleep)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Simulate the Borbely two-process model of sleep regulation.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--params', help='config.py-style Python file or JSON file (default: config.py)')
+    common.add_argument('--set', type=_parse_assignment, action='append', default=[], metavar='NAME=VALUE', help='override a parameter')
+    common.add_argument('--start', type=float, default=0.0, help='start time in hours')
+    common.add_argument('--hours', type=float, default=100.0, help='simulated duration in hours')
+    common.add_argument('--dt', type=float, default=0.5, help='time step in hours')
+    common.add_argument('--H0', type=float, default=0.1, help='initial sleep pressure')
+    common.add_argument('--asleep', action='store_true', help='start asleep instead of awake')
+    common.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING'], help="show events of the 'borbely' logger on stderr")
+    common.add_argument('--metrics', help='write timers and counters of the run to this JSON file')
+    common.add_argument('--profile', action='store_true', help='run under cProfile and tracemalloc (reported with --metrics)')
+
+    selection = argparse.ArgumentParser(add_help=False)
+    selection.add_argument('--config', action='append', metavar='KEY', help="configuration simulation_key to run, or 'all'")
+
+    simulate = subparsers.add_parser('simulate', parents=[common, selection], help='simulate and print sleep onsets/offsets')
+    simulate.add_argument('--output', help='directory to save each run to (SleepData.save)')
+    simulate.set_defaults(func=cmd_simulate)
+
+    stats = subparsers.add_parser('stats', parents=[common, selection], help='print sleep metrics as JSON')
+    stats.add_argument('--input', nargs='+', help='saved SleepData directories to summarize instead of simulating')
+    stats.add_argument('--output', help='JSON file to write instead of stdout')
+    stats.set_defaults(func=cmd_stats)
+
+    sweep = subparsers.add_parser('sweep', parents=[common], help='run a parameter sweep and write a CSV table')
+    sweep.add_argument('--grid', type=_parse_assignment, action='append', required=True, metavar='NAME=V1,V2,...')
+    sweep.add_argument('--processes', type=int, default=1)
+    sweep.add_argument('--chunk-size', type=int, default=1000)
+    sweep.add_argument('--progress', action='store_true')
+    sweep.add_argument('--output', help='CSV file to write instead of stdout')
+    sweep.set_defaults(func=cmd_sweep)
+
+    plot = subparsers.add_parser('plot', parents=[common, selection], help='plot the selected runs')
+    plot.add_argument('--output-dir', help='render to files here instead of opening a window')
+    plot.add_argument('--format', default='png')
+    plot.add_argument('--processes', type=int)
+    plot.set_defaults(func=cmd_plot)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.log_level:
+        import logging
+        logging.basicConfig(level=args.log_level, stream=sys.stderr)
+    if not (args.metrics or args.profile):
+        args.func(args)
+        return 0
+
+    from instrumentation import metrics
+    with metrics.profile(args.command, trace_memory=True) if args.profile else metrics.phase('command'):
+        args.func(args)
+    if args.metrics:
+        metrics.export_json(args.metrics)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
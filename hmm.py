@@ -0,0 +1,105 @@
+import numpy as np
+
+from borbely import BorbelyModel
+
+# Hidden-Markov sleep/wake decoding with transition probabilities driven by the Borbely model.
+# State 0 is asleep and state 1 is awake, matching the awake arrays of SleepData.
+# Everything runs in log space on (N, T) batches: emission and transition terms are computed for all
+# time steps at once, and the forward, backward and Viterbi recursions advance all N subjects together.
+
+def _log_sigmoid(x):
+    return -np.logaddexp(0, -x)
+
+class BorbelyHMM:
+    # This class decodes sleep/wake states from noisy activity with a two-state HMM whose transition
+    # probabilities follow the Borbely thresholds: falling asleep becomes likely as H rises past the
+    # upper bound, waking up as H drops below the lower bound. sharpness sets how soft the thresholds are.
+    # Activity is modelled as Gaussian with one mean and standard deviation per state.
+    def __init__(self, model=None, sharpness=0.02, emission_means=(0.0, 1.0), emission_stds=(0.5, 0.5), initial_awake=0.5):
+        self.model = BorbelyModel() if model is None else model
+        self.sharpness = sharpness
+        self.emission_means = np.asarray(emission_means, dtype=float)
+        self.emission_stds = np.asarray(emission_stds, dtype=float)
+        self.initial_awake = initial_awake
+
+    def transition_log_probs(self, H, upper, lower):
+        # Log transition matrices (..., T-1, 2, 2) for the steps into samples 1..T-1, indexed [from, to].
+        sleep_onset = (H[..., 1:] - upper[..., 1:]) / self.sharpness
+        wake_onset = (lower[..., 1:] - H[..., 1:]) / self.sharpness
+        log_probs = np.empty(np.shape(sleep_onset) + (2, 2))
+        log_probs[..., 0, 0] = _log_sigmoid(-wake_onset)
+        log_probs[..., 0, 1] = _log_sigmoid(wake_onset)
+        log_probs[..., 1, 0] = _log_sigmoid(sleep_onset)
+        log_probs[..., 1, 1] = _log_sigmoid(-sleep_onset)
+        return log_probs
+
+    def emission_log_probs(self, activity):
+        # Gaussian log likelihood of each activity sample under each state, shape (..., T, 2).
+        z = (np.asarray(activity, dtype=float)[..., None] - self.emission_means) / self.emission_stds
+        return -0.5 * z ** 2 - np.log(self.emission_stds * np.sqrt(2 * np.pi))
+
+    def _time_major_terms(self, activity, H, upper, lower):
+        # Log initial vector (N, 2) and per-step log matrices (T-1, N, 2, 2) that include the emission of
+        # the target state, laid out time-major so each step of a recursion reads one contiguous block.
+        activity, H, upper, lower = np.broadcast_arrays(*(np.atleast_2d(np.asarray(x, dtype=float)) for x in (activity, H, upper, lower)))
+        emissions = self.emission_log_probs(activity)
+        log_initial = np.log([1 - self.initial_awake, self.initial_awake]) + emissions[:, 0, :]
+        steps = self.transition_log_probs(H, upper, lower) + emissions[:, 1:, None, :]
+        return log_initial, np.ascontiguousarray(np.moveaxis(steps, 1, 0))
+
+    @staticmethod
+    def _squeeze(sequence_shape, *results):
+        # Drop the subject axis again for a single (T,) sequence.
+        return results if len(sequence_shape) > 1 else tuple(result[0] for result in results)
+
+    def forward_backward(self, activity, H, upper, lower):
+        # Return the posterior probability of being awake (..., T) and the log likelihood (...,) of each sequence.
+        log_initial, steps = self._time_major_terms(activity, H, upper, lower)
+        n_steps = len(steps)
+
+        alpha = np.empty((n_steps + 1,) + log_initial.shape)
+        alpha[0] = log_initial
+        for t in range(n_steps):
+            paths = alpha[t][:, :, None] + steps[t]
+            alpha[t + 1] = np.logaddexp(paths[:, 0], paths[:, 1])
+
+        beta = np.zeros_like(alpha)
+        for t in range(n_steps - 1, -1, -1):
+            paths = steps[t] + beta[t + 1][:, None, :]
+            beta[t] = np.logaddexp(paths[:, :, 0], paths[:, :, 1])
+
+        log_likelihood = np.logaddexp(alpha[-1][:, 0], alpha[-1][:, 1])
+        posterior_awake = np.exp(alpha[:, :, 1] + beta[:, :, 1] - log_likelihood).T
+        return self._squeeze(np.shape(activity), posterior_awake, log_likelihood)
+
+    def viterbi(self, activity, H, upper, lower):
+        # Return the most likely awake path (..., T) and its log probability (...,).
+        log_initial, steps = self._time_major_terms(activity, H, upper, lower)
+        n_steps = len(steps)
+        subjects = np.arange(len(log_initial))
+
+        delta = log_initial
+        backpointers = np.empty((n_steps,) + log_initial.shape, dtype=np.int8)
+        for t in range(n_steps):
+            scores = delta[:, :, None] + steps[t]
+            backpointers[t] = np.argmax(scores, axis=1)
+            delta = np.max(scores, axis=1)
+
+        path = np.empty((n_steps + 1, len(log_initial)), dtype=np.int8)
+        path[-1] = np.argmax(delta, axis=1)
+        for t in range(n_steps - 1, -1, -1):
+            path[t] = backpointers[t][subjects, path[t + 1]]
+
+        return self._squeeze(np.shape(activity), path.T.astype(bool), np.max(delta, axis=1))
+
+    def decode(self, activity, ts, params_table=None, sleep_pressure_T0=0.1, wake_status_T0=True):
+        # Simulate the prior H trajectory and bounds for every subject (one row of params_table per row of
+        # activity, default parameters if None) and decode the (N, T) activity with them.
+        # Returns (posterior_awake, viterbi_awake, log_likelihood).
+        # A single (T,) recording keeps its shape: forward_backward/viterbi drop the subject axis again
+        if params_table is None:
+            params_table = [{}] * len(np.atleast_2d(activity))
+        batch = self.model.simulate_batch(params_table, ts, sleep_pressure_T0, wake_status_T0)
+        posterior_awake, log_likelihood = self.forward_backward(activity, batch.H, batch.upper, batch.lower)
+        viterbi_awake, _ = self.viterbi(activity, batch.H, batch.upper, batch.lower)
+        return posterior_awake, viterbi_awake, log_likelihood
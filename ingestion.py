@@ -0,0 +1,148 @@
+import csv
+import itertools
+import os
+import zipfile
+
+import numpy as np
+
+# Streaming ingestion of actigraphy / sleep-diary recordings.
+# A recording is a long table with one row per sample and the columns subject, time (hours) and a value
+# column: either 'awake' (1 awake, 0 asleep) or an activity count that is thresholded into a wake mask.
+# Rows must be grouped by subject and sorted by time within a subject. Files are read in chunks of
+# chunk_rows rows and only one subject is held in memory at a time.
+
+def read_csv_chunks(path, value_column='awake', chunk_rows=1_000_000):
+    # Yield chunks of a CSV file with a header row as dicts of 'subject', 'time' and 'value' arrays.
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        subject_col, time_col, value_col = (header.index(name) for name in ('subject', 'time', value_column))
+        while True:
+            rows = list(itertools.islice(reader, chunk_rows))
+            if not rows:
+                break
+            yield {
+                'subject': np.array([row[subject_col] for row in rows]),
+                'time': np.array([row[time_col] for row in rows], dtype=float),
+                'value': np.array([row[value_col] for row in rows], dtype=float),
+            }
+
+def _read_npz_member(member, chunk_rows):
+    # Yield consecutive chunks of a 1-D array stored in an open .npz member, decompressing as it goes.
+    version = np.lib.format.read_magic(member)
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+    shape, fortran_order, dtype = read_header(member)
+    if dtype.hasobject or len(shape) != 1:
+        raise ValueError(f"Cannot stream {member.name}: expected a 1-D array without Python objects")
+    for first in range(0, shape[0], chunk_rows):
+        count = min(chunk_rows, shape[0] - first)
+        yield np.frombuffer(member.read(count * dtype.itemsize), dtype=dtype, count=count)
+
+def read_columnar_chunks(path, value_column='awake', chunk_rows=1_000_000):
+    # Yield chunks of a columnar recording: a directory of subject.npy/time.npy/<value_column>.npy files,
+    # which are memory-mapped, or an .npz archive with those arrays, whose members (compressed or not)
+    # are read chunk by chunk. Either way only one chunk per column is in memory at a time.
+    names = ('subject', 'time', value_column)
+    if os.path.isdir(path):
+        columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in names}
+        for first in range(0, len(columns['time']), chunk_rows):
+            rows = slice(first, first + chunk_rows)
+            yield {
+                'subject': np.asarray(columns['subject'][rows]),
+                'time': np.asarray(columns['time'][rows], dtype=float),
+                'value': np.asarray(columns[value_column][rows], dtype=float),
+            }
+        return
+
+    with zipfile.ZipFile(path) as archive:
+        members = [archive.open(name + '.npy') for name in names]
+        try:
+            for subject, time, value in zip(*(_read_npz_member(member, chunk_rows) for member in members)):
+                yield {'subject': subject, 'time': time.astype(float), 'value': value.astype(float)}
+        finally:
+            for member in members:
+                member.close()
+
+def read_parquet_chunks(path, value_column='awake', chunk_rows=1_000_000):
+    # Yield chunks of a Parquet file batch by batch. Requires pyarrow.
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=['subject', 'time', value_column]):
+        yield {
+            'subject': batch.column('subject').to_numpy(zero_copy_only=False),
+            'time': batch.column('time').to_numpy(zero_copy_only=False).astype(float),
+            'value': batch.column(value_column).to_numpy(zero_copy_only=False).astype(float),
+        }
+
+def read_chunks(path, value_column='awake', chunk_rows=1_000_000):
+    # Pick the reader from the file name.
+    if path.endswith('.csv'):
+        return read_csv_chunks(path, value_column, chunk_rows)
+    if path.endswith('.parquet'):
+        return read_parquet_chunks(path, value_column, chunk_rows)
+    return read_columnar_chunks(path, value_column, chunk_rows)
+
+def iter_subject_rows(chunks):
+    # Regroup a stream of chunks into (subject, time, value) per subject, joining subjects split across chunks.
+    pending_subject, pending = None, []
+    for chunk in chunks:
+        subjects = chunk['subject']
+        boundaries = np.flatnonzero(subjects[1:] != subjects[:-1]) + 1
+        for start, stop in zip(np.concatenate([[0], boundaries]), np.concatenate([boundaries, [len(subjects)]])):
+            subject = subjects[start]
+            if pending and subject != pending_subject:
+                yield pending_subject, np.concatenate([p[0] for p in pending]), np.concatenate([p[1] for p in pending])
+                pending = []
+            pending_subject = subject
+            pending.append((chunk['time'][start:stop], chunk['value'][start:stop]))
+    if pending:
+        yield pending_subject, np.concatenate([p[0] for p in pending]), np.concatenate([p[1] for p in pending])
+
+def regular_grid(times, dt):
+    # A regular time base with step dt covering the recorded times.
+    n_steps = int(np.floor((times[-1] - times[0]) / dt)) + 1
+    return times[0] + np.arange(n_steps) * dt
+
+def resample(times, values, ts, method='hold'):
+    # Resample irregular samples onto ts (regular or not).
+    # 'hold' takes the last sample at or before each ts (the first sample before the recording starts);
+    # 'mean' averages the samples in [ts[i], ts[i+1]), holding the previous value through empty bins.
+    held = np.clip(np.searchsorted(times, ts, side='right') - 1, 0, len(times) - 1)
+    if method == 'hold':
+        return values[held]
+
+    edges = np.searchsorted(times, ts, side='left')
+    counts = np.diff(np.append(edges, np.searchsorted(times, np.inf)))
+    sums = np.add.reduceat(np.append(values, 0.0), np.minimum(edges, len(values)))
+    return np.where(counts > 0, sums / np.maximum(counts, 1), values[held])
+
+class SubjectRecord:
+    # This class holds one subject resampled onto its time base, ready for BorbelyModel.calculate_sleep_pressure
+    # (or calculate_sleep_pressure_scan) and for comparisons with simulate().
+    def __init__(self, subject, ts, awake):
+        self.subject = subject
+        self.ts = ts
+        self.awake = awake
+
+    def sleep_pressure(self, model, H0):
+        # Replay the observed wake mask through Process S.
+        return model.calculate_sleep_pressure_scan(self.ts, H0, self.awake)
+
+def ingest(path, dt=None, ts=None, value_column='awake', threshold=None, chunk_rows=1_000_000):
+    # Stream a recording, returning an iterator over one SubjectRecord per subject.
+    # The time base is ts if given (shared by all subjects), otherwise a regular grid with step dt per subject.
+    # With threshold set, value_column is an activity count and a sample counts as awake when its
+    # bin-averaged activity exceeds threshold; otherwise it is already a 0/1 wake column.
+    # The arguments are checked here, before the generator is returned, so mistakes fail at the call.
+    if dt is None and ts is None:
+        raise ValueError("ingest needs a time base: pass dt (regular grid per subject) or ts (shared grid)")
+    return _ingest(path, dt, ts, value_column, threshold, chunk_rows)
+
+def _ingest(path, dt, ts, value_column, threshold, chunk_rows):
+    for subject, times, values in iter_subject_rows(read_chunks(path, value_column, chunk_rows)):
+        subject_ts = ts if ts is not None else regular_grid(times, dt)
+        if threshold is None:
+            awake = resample(times, values, subject_ts, method='hold') > 0.5
+        else:
+            awake = resample(times, values, subject_ts, method='mean') > threshold
+        yield SubjectRecord(subject, subject_ts, awake)
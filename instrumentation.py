@@ -0,0 +1,90 @@
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import pstats
+import time
+import tracemalloc
+
+# Instrumentation shared by the model, cache and plotting code.
+# Events go to the 'borbely' logger (silent unless logging is configured, e.g. logging.basicConfig(level=logging.INFO)).
+# Per-phase wall times and counters are collected in the module-level `metrics` object and can be exported as JSON.
+
+logger = logging.getLogger('borbely')
+
+class Instrumentation:
+    # This class accumulates per-phase timers (total seconds and number of calls) and named counters.
+    # Collection can be switched off with enabled = False; phase() then costs a single attribute check.
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.timers = {}
+        self.counters = {}
+        self.profiles = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Time the enclosed block and add it to the timer called name.
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            total, calls = self.timers.get(name, (0.0, 0))
+            self.timers[name] = (total + elapsed, calls + 1)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def profile(self, name='profile', cprofile=True, trace_memory=False, top=20):
+        # Run the enclosed block (e.g. a single simulate call) under cProfile and/or tracemalloc.
+        # The top functions by cumulative time and the peak traced memory are kept in profiles.
+        profiler = cProfile.Profile() if cprofile else None
+        started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if trace_memory:
+            tracemalloc.reset_peak()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            record = {'name': name}
+            if profiler is not None:
+                profiler.disable()
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(top)
+                record['cprofile'] = out.getvalue()
+            if trace_memory:
+                record['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                if started_tracing:
+                    tracemalloc.stop()
+            self.profiles.append(record)
+
+    def to_dict(self):
+        return {
+            'timers': {name: {'seconds': total, 'calls': calls} for name, (total, calls) in self.timers.items()},
+            'counters': dict(self.counters),
+            'profiles': list(self.profiles),
+        }
+
+    def export_json(self, path=None):
+        # Return the collected metrics as a JSON string, also writing them to path if given.
+        text = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def reset(self):
+        self.timers.clear()
+        self.counters.clear()
+        self.profiles.clear()
+
+metrics = Instrumentation()
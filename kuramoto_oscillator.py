@@ -0,0 +1,61 @@
+import numpy as np
+
+from borbely import BorbelyModel
+
+class KuramotoPopulation:
+    # This class represents a population of N coupled circadian oscillators (Kuramoto model):
+    #   d(theta_i)/dt = omega_i + K * r * sin(psi - theta_i) + Z * sin(Omega * t - theta_i)
+    # where r * exp(i * psi) is the mean field of all phases. Coupling through the mean field costs O(N)
+    # per step instead of O(N^2) pairwise terms. Z is an optional shared zeitgeber (e.g. daylight) at frequency Omega.
+    # The phases play the role of circadian_frequency * t - circadian_phase_shift in ProcessC.
+    def __init__(self, n_oscillators, natural_frequency=2 * np.pi / 24, frequency_spread=0.0, coupling=0.0,
+                 initial_phases=None, zeitgeber_strength=0.0, zeitgeber_frequency=2 * np.pi / 24, seed=None):
+        rng = np.random.default_rng(seed)
+        self.n_oscillators = n_oscillators
+        # Natural frequencies are normally distributed around natural_frequency, unless given per oscillator
+        if np.ndim(natural_frequency) > 0:
+            self.natural_frequencies = np.asarray(natural_frequency, dtype=float)
+        else:
+            self.natural_frequencies = natural_frequency + frequency_spread * rng.standard_normal(n_oscillators)
+        if initial_phases is None:
+            initial_phases = rng.uniform(-np.pi, np.pi, n_oscillators)
+        self.initial_phases = np.broadcast_to(np.asarray(initial_phases, dtype=float), (n_oscillators,)).copy()
+        self.coupling = coupling
+        self.zeitgeber_strength = zeitgeber_strength
+        self.zeitgeber_frequency = zeitgeber_frequency
+
+    @staticmethod
+    def mean_field(phases):
+        # Return the order parameter r and mean phase psi of phases along the last axis.
+        z = np.exp(1j * phases).mean(axis=-1)
+        return np.abs(z), np.angle(z)
+
+    def phase_velocity(self, t, phases):
+        r, psi = self.mean_field(phases)
+        velocity = self.natural_frequencies + self.coupling * r * np.sin(psi - phases)
+        if self.zeitgeber_strength:
+            velocity += self.zeitgeber_strength * np.sin(self.zeitgeber_frequency * t - phases)
+        return velocity
+
+    def integrate(self, ts):
+        # Integrate the phases over ts with a classical Runge-Kutta step and return them as an (N, T) array.
+        ts = np.asarray(ts, dtype=float)
+        phases = np.empty((len(ts), self.n_oscillators))
+        phases[0] = self.initial_phases
+        for i in range(1, len(ts)):
+            t, dt, theta = ts[i-1], ts[i] - ts[i-1], phases[i-1]
+            k1 = self.phase_velocity(t, theta)
+            k2 = self.phase_velocity(t + dt / 2, theta + dt / 2 * k1)
+            k3 = self.phase_velocity(t + dt / 2, theta + dt / 2 * k2)
+            k4 = self.phase_velocity(t + dt, theta + dt * k3)
+            phases[i] = theta + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        return phases.T
+
+    def simulate_sleep(self, ts, sleep_pressure_T0, wake_status_T0=False, params_table=None, model=None):
+        # Drive one Borbely subject per oscillator with its phase in place of the fixed circadian sinusoid,
+        # and simulate all of them through the batched path. Returns (BatchSleepData, phases).
+        model = BorbelyModel() if model is None else model
+        if params_table is None:
+            params_table = [{}] * self.n_oscillators
+        phases = self.integrate(ts)
+        return model.simulate_batch(params_table, ts, sleep_pressure_T0, wake_status_T0, circadian_phase=phases), phases
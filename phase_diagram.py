@@ -0,0 +1,142 @@
+import itertools
+
+import numpy as np
+
+from borbely import BorbelyModel
+from config import default_params
+
+# Regime maps over 2 (or 3) Borbely parameters, e.g. circadian_amplitude x circadian_phase_shift.
+# Every parameter point is simulated until it has settled and classified by its steady-state pattern.
+# The map is refined adaptively: a cell is split into 2^d children only while its corners disagree, so
+# simulations concentrate along the regime boundaries. Corners are kept in a cache keyed by their integer
+# lattice coordinates, so a corner shared by neighbouring cells (or levels) is simulated once.
+
+REGIMES = ('no_sleep', 'monophasic', 'biphasic', 'polyphasic', 'free_running', 'no_wake')
+MIXED = -1  # Label of a cell at the finest level whose corners still disagree
+
+def classify_awake(awake, steps_per_day, max_cycle_days=7):
+    # Classify the end of a settled wake mask. The pattern is periodic with p days (p <= max_cycle_days)
+    # when the last max_cycle_days days repeat p days earlier; it is then monophasic/biphasic/polyphasic
+    # by sleep onsets per day, and free-running when no such p exists or the onsets are not a whole
+    # number per day. Returns an index into REGIMES.
+    window = max_cycle_days * steps_per_day
+    for p in range(1, max_cycle_days + 1):
+        shift = p * steps_per_day
+        if len(awake) < window + shift:
+            break
+        if np.array_equal(awake[-window:], awake[-window - shift:-shift]):
+            cycle = awake[-shift - 1:]
+            onsets = np.count_nonzero(cycle[:-1] & ~cycle[1:])
+            if onsets == 0:
+                return REGIMES.index('no_sleep' if cycle.all() else 'no_wake')
+            per_day, remainder = divmod(onsets, p)
+            if remainder:
+                break
+            return REGIMES.index({1: 'monophasic', 2: 'biphasic'}.get(per_day, 'polyphasic'))
+    return REGIMES.index('free_running')
+
+class PhaseDiagram:
+    # This class holds the result of PhaseMapper.run: the leaf cells of the refinement tree and the
+    # classified corners. Cell and corner positions are integer coordinates on the finest lattice,
+    # which has `resolution` cells per axis spanning [low, high].
+    def __init__(self, names, low, high, resolution, cell_level, cell_origin, cell_label, corners, max_depth):
+        self.names = names
+        self.low = low
+        self.high = high
+        self.resolution = resolution
+        self.cell_level = cell_level
+        self.cell_origin = cell_origin
+        self.cell_label = cell_label
+        self.corners = corners
+        self.max_depth = max_depth
+
+    @property
+    def n_evaluations(self):
+        return len(self.corners)
+
+    @property
+    def uniform_evaluations(self):
+        # Simulations a uniform grid at the finest resolution would have needed.
+        return (self.resolution + 1) ** len(self.names)
+
+    def coordinates(self, lattice):
+        # Parameter values of integer lattice coordinates, shape (..., d).
+        return self.low + np.asarray(lattice) / self.resolution * (self.high - self.low)
+
+    def points(self):
+        # (parameter values (n, d), regime indices (n,)) of every simulated corner.
+        lattice = np.array(list(self.corners), dtype=float).reshape(-1, len(self.names))
+        return self.coordinates(lattice), np.array(list(self.corners.values()), dtype=int)
+
+    def grid(self):
+        # Regime index of every finest-level cell, shape (resolution,) * d (axis j follows names[j]).
+        # Cells at the finest level that are still mixed take the regime of their lowest corner.
+        grid = np.empty((self.resolution,) * len(self.names), dtype=int)
+        for level, origin, label in zip(self.cell_level, self.cell_origin, self.cell_label):
+            size = 2 ** (self.max_depth - level)
+            if label == MIXED:
+                label = self.corners[tuple(origin)]
+            grid[tuple(slice(o, o + size) for o in origin)] = label
+        return grid
+
+class PhaseMapper:
+    # This class builds a PhaseDiagram over bounds = {name: (low, high)} for 2 or 3 parameters,
+    # starting from base_resolution cells per axis and splitting cells up to max_depth times.
+    # Each corner is simulated over settle_days plus 2 * max_cycle_days days, in batches of batch_size,
+    # and classified by classify_awake. dt must divide the circadian period.
+    def __init__(self, bounds, base_params=None, dt=0.25, settle_days=30, max_cycle_days=7,
+                 sleep_pressure_T0=0.1, wake_status_T0=True, base_resolution=4, max_depth=4, batch_size=1000):
+        self.names = list(bounds)
+        self.low = np.array([bounds[name][0] for name in self.names], dtype=float)
+        self.high = np.array([bounds[name][1] for name in self.names], dtype=float)
+        self.model = BorbelyModel(default_params if base_params is None else base_params)
+        self.dt = dt
+        self.max_cycle_days = max_cycle_days
+        self.ts = np.arange(0, 24 * (settle_days + 2 * max_cycle_days), dt)
+        self.sleep_pressure_T0 = sleep_pressure_T0
+        self.wake_status_T0 = wake_status_T0
+        self.base_resolution = base_resolution
+        self.max_depth = max_depth
+        self.batch_size = batch_size
+        self.resolution = base_resolution * 2 ** max_depth
+        self.corners = {}
+
+    def _evaluate(self, lattice_points):
+        # Classify the lattice points that are not in the corner cache yet, in batches.
+        todo = [point for point in dict.fromkeys(lattice_points) if point not in self.corners]
+        for first in range(0, len(todo), self.batch_size):
+            chunk = todo[first:first + self.batch_size]
+            values = self.low + np.array(chunk, dtype=float) / self.resolution * (self.high - self.low)
+            overrides = [dict(zip(self.names, row)) for row in values]
+            batch = self.model.simulate_batch(overrides, self.ts, self.sleep_pressure_T0, self.wake_status_T0)
+            steps_per_day = np.rint(2 * np.pi / batch.params['circadian_frequency'] / self.dt).astype(int)
+            for point, awake, steps in zip(chunk, batch.awake, steps_per_day):
+                self.corners[point] = classify_awake(awake, steps, self.max_cycle_days)
+
+    def run(self):
+        d = len(self.names)
+        offsets = np.array(list(itertools.product((0, 1), repeat=d)))
+        size = 2 ** self.max_depth
+        cells = [np.array(origin) * size for origin in itertools.product(range(self.base_resolution), repeat=d)]
+
+        levels, origins, labels = [], [], []
+        for level in range(self.max_depth + 1):
+            if not cells:
+                break
+            size = 2 ** (self.max_depth - level)
+            cell_corners = [[tuple(origin + offset * size) for offset in offsets] for origin in cells]
+            self._evaluate([corner for corners in cell_corners for corner in corners])
+
+            split = []
+            for origin, corners in zip(cells, cell_corners):
+                corner_labels = {self.corners[corner] for corner in corners}
+                if len(corner_labels) == 1 or level == self.max_depth:
+                    levels.append(level)
+                    origins.append(origin)
+                    labels.append(corner_labels.pop() if len(corner_labels) == 1 else MIXED)
+                else:
+                    split.extend(origin + offset * (size // 2) for offset in offsets)
+            cells = split
+
+        return PhaseDiagram(self.names, self.low, self.high, self.resolution, np.array(levels), np.array(origins),
+                            np.array(labels), dict(self.corners), self.max_depth)
@@ -0,0 +1,91 @@
+import numpy as np
+
+from borbely import ProcessC
+
+# Piecewise-constant parameter schedules, e.g. a flight on day 10 or a rota that changes every week.
+# A schedule is a list of (time in hours, overrides) changes applied on top of the model's parameters;
+# each change stays in force, on top of the earlier ones, until a later change overrides it again.
+# A change of circadian_phase_shift shifts the circadian rhythm instantly at its breakpoint.
+
+class ParameterSchedule:
+    def __init__(self, changes=()):
+        self.changes = sorted(((t, dict(overrides)) for t, overrides in changes), key=lambda change: change[0])
+
+    def add(self, t, **overrides):
+        # Add a change at time t (hours). Non-numeric entries such as 'title' are ignored, so
+        # entries of config.configurations can be passed as they are: schedule.add(240, **config).
+        self.changes.append((t, overrides))
+        self.changes.sort(key=lambda change: change[0])
+        return self
+
+    @classmethod
+    def rota(cls, start, period, configurations, n_periods):
+        # Cycle through configurations (dicts of overrides), switching every period hours from start.
+        return cls((start + k * period, configurations[k % len(configurations)]) for k in range(n_periods))
+
+    def compile(self, base_params):
+        # Resolve the changes into breakpoint and per-segment parameter arrays.
+        keys = [key for key, value in base_params.items() if not isinstance(value, str)]
+        breakpoints = [-np.inf]
+        rows = [dict(base_params)]
+        for t, overrides in self.changes:
+            row = {**rows[-1], **{key: value for key, value in overrides.items() if key in keys}}
+            if t == breakpoints[-1]:
+                rows[-1] = row
+            else:
+                breakpoints.append(t)
+                rows.append(row)
+        params = {key: np.array([row[key] for row in rows], dtype=float) for key in keys}
+        return CompiledSchedule(np.array(breakpoints, dtype=float), params)
+
+class CompiledSchedule:
+    # This class holds a schedule as arrays: segment k has the parameters params[key][k] from
+    # breakpoints[k] (inclusive) until breakpoints[k+1]. Curves are evaluated with one vectorized
+    # ProcessC call per segment instead of per-step parameter lookups.
+    def __init__(self, breakpoints, params):
+        self.breakpoints = breakpoints
+        self.params = params
+
+    def __len__(self):
+        return len(self.breakpoints)
+
+    def segment_index(self, t):
+        return np.searchsorted(self.breakpoints, t, side='right') - 1
+
+    def params_at(self, t):
+        # The parameters in force at time t, as a plain dict.
+        k = self.segment_index(t)
+        return {key: values[k].item() for key, values in self.params.items()}
+
+    def process_c(self, k):
+        p = self.params
+        return ProcessC(p['circadian_frequency'][k], p['circadian_phase_shift'][k], p['circadian_amplitude'][k], p['UpperBound_Sleep_Pressure'][k], p['LowerBound_Sleep_Pressure'][k])
+
+    def _per_segment(self, t, curve):
+        # Evaluate curve(process_c, t_segment) on the part of t in each segment.
+        t = np.asarray(t, dtype=float)
+        segment = self.segment_index(t)
+        result = np.empty(t.shape)
+        for k in np.unique(segment):
+            in_segment = segment == k
+            result[in_segment] = curve(self.process_c(k), t[in_segment])
+        return result
+
+    def calculate_circadian_rhythm(self, t):
+        return self._per_segment(t, ProcessC.calculate_circadian_rhythm)
+
+    def calculate_upper_bound(self, t):
+        return self._per_segment(t, ProcessC.calculate_upper_bound)
+
+    def calculate_lower_bound(self, t):
+        return self._per_segment(t, ProcessC.calculate_lower_bound)
+
+    def decay_factors(self, ts):
+        # Per-step factors for the step from ts[i] to ts[i+1], using the parameters in force at ts[i]:
+        # returns (wake_decay, sleep_decay, wake_baseline), each of shape (T - 1,).
+        ts = np.asarray(ts, dtype=float)
+        dt = np.diff(ts)
+        segment = self.segment_index(ts[:-1])
+        wake_decay = np.exp(-dt / self.params['Wake_Decay_Rate'][segment])
+        sleep_decay = np.exp(-dt / self.params['Sleep_Decay_Rate'][segment])
+        return wake_decay, sleep_decay, self.params['Wake_Baseline_Pressure'][segment]
@@ -0,0 +1,123 @@
+import numpy as np
+
+from config import configurations, default_params
+from sweep import ParameterSweep
+
+# Global (variance-based) sensitivity analysis of the sleep metrics to the Borbely parameters.
+# Samples come from an unscrambled Sobol sequence, indices use the Saltelli (first-order) and Jansen
+# (total-effect) estimators on the A/B/AB_i sample matrices.
+
+# Joe-Kuo (new-joe-kuo-6.21201) primitive polynomials and initial direction numbers for dimensions 2..21;
+# dimension 1 is the van der Corput sequence. This covers Saltelli designs of up to 10 parameters.
+_SOBOL_DIRECTIONS = [
+    (3, [1]), (7, [1, 3]), (11, [1, 3, 1]), (13, [1, 1, 1]), (19, [1, 1, 3, 3]),
+    (25, [1, 3, 5, 13]), (37, [1, 1, 5, 5, 17]), (41, [1, 1, 5, 5, 5]), (47, [1, 1, 7, 11, 19]),
+    (55, [1, 1, 5, 1, 1]), (59, [1, 1, 1, 3, 11]), (61, [1, 3, 5, 5, 31]), (67, [1, 3, 3, 9, 7, 49]),
+    (91, [1, 1, 1, 15, 21, 21]), (97, [1, 3, 1, 13, 27, 49]), (103, [1, 1, 1, 15, 7, 5]),
+    (109, [1, 3, 1, 15, 13, 25]), (115, [1, 1, 5, 5, 19, 61]), (131, [1, 3, 7, 11, 23, 15, 103]),
+    (137, [1, 3, 7, 13, 13, 15, 69]),
+]
+_SOBOL_BITS = 30
+
+def _direction_numbers(dimensions):
+    # Direction numbers V[d, k] for bit k of the point index, as integers scaled by 2**_SOBOL_BITS.
+    if dimensions > len(_SOBOL_DIRECTIONS) + 1:
+        raise ValueError(f"Sobol sequence supports at most {len(_SOBOL_DIRECTIONS) + 1} dimensions")
+    V = np.zeros((dimensions, _SOBOL_BITS), dtype=np.int64)
+    V[0] = 1 << np.arange(_SOBOL_BITS - 1, -1, -1)
+    for d in range(1, dimensions):
+        poly, m_init = _SOBOL_DIRECTIONS[d - 1]
+        degree = poly.bit_length() - 1
+        m = list(m_init)
+        for k in range(degree, _SOBOL_BITS):
+            value = m[k - degree] ^ (m[k - degree] << degree)
+            for i in range(1, degree):
+                if (poly >> (degree - i)) & 1:
+                    value ^= m[k - i] << i
+            m.append(value)
+        V[d] = [m[k] << (_SOBOL_BITS - 1 - k) for k in range(_SOBOL_BITS)]
+    return V
+
+def sobol_points(first, count, dimensions):
+    # Points first .. first + count - 1 of the Sobol sequence in [0, 1)^dimensions, shape (count, dimensions).
+    # Any stretch of the sequence can be generated directly, which is what makes extending a run cheap.
+    V = _direction_numbers(dimensions)
+    index = np.arange(first, first + count, dtype=np.int64)
+    gray = index ^ (index >> 1)
+    points = np.zeros((count, dimensions), dtype=np.int64)
+    for k in range(_SOBOL_BITS):
+        points ^= ((gray >> k) & 1)[:, None] * V[:, k]
+    return points / float(1 << _SOBOL_BITS)
+
+def regime_bounds(regime, names, spread=0.2):
+    # Sampling ranges around a regime of config.configurations (by simulation_key): +/- spread relative
+    # to each base value, and +/- spread * 12 h for circadian_phase_shift, which is often 0.
+    base = {**default_params, **next(config for config in configurations if config['simulation_key'] == regime)}
+    bounds = {}
+    for name in names:
+        if name == 'circadian_phase_shift':
+            bounds[name] = (base[name] - 12 * spread, base[name] + 12 * spread)
+        else:
+            bounds[name] = (base[name] * (1 - spread), base[name] * (1 + spread))
+    return base, bounds
+
+class SobolAnalysis:
+    # This class estimates first-order and total-effect Sobol indices of the sleep metrics.
+    # Every extend() call evaluates n more base samples, i.e. n * (D + 2) simulations, through a
+    # ParameterSweep (optionally across processes) and appends them, so a run can be refined without
+    # recomputing what has already been simulated.
+    def __init__(self, bounds, ts, sleep_pressure_T0=0.1, wake_status_T0=True, base_params=None,
+                 metrics=('sleep_hours_per_day', 'episodes_per_day', 'mean_episode_duration', 'mean_H_at_onset'), chunk_size=1000):
+        self.names = list(bounds)
+        self.low = np.array([bounds[name][0] for name in self.names], dtype=float)
+        self.high = np.array([bounds[name][1] for name in self.names], dtype=float)
+        self.ts = ts
+        self.sleep_pressure_T0 = sleep_pressure_T0
+        self.wake_status_T0 = wake_status_T0
+        self.base_params = default_params if base_params is None else base_params
+        self.metrics = list(metrics)
+        self.chunk_size = chunk_size
+
+        n_params = len(self.names)
+        self.n_samples = 0
+        self.f_A = np.empty((0, len(self.metrics)))
+        self.f_B = np.empty((0, len(self.metrics)))
+        self.f_AB = np.empty((n_params, 0, len(self.metrics)))
+
+    def extend(self, n, processes=1, progress=None):
+        # Evaluate the next n points of the sequence (skipping the all-zero first point).
+        n_params = len(self.names)
+        points = sobol_points(self.n_samples + 1, n, 2 * n_params)
+        A = self.low + points[:, :n_params] * (self.high - self.low)
+        B = self.low + points[:, n_params:] * (self.high - self.low)
+        AB = np.repeat(A[None, :, :], n_params, axis=0)
+        AB[np.arange(n_params), :, np.arange(n_params)] = B.T
+
+        samples = np.concatenate([A, B, AB.reshape(-1, n_params)])
+        overrides = [dict(zip(self.names, row)) for row in samples]
+        result = ParameterSweep(overrides, self.base_params, self.chunk_size).run(self.ts, self.sleep_pressure_T0, self.wake_status_T0, processes, progress)
+        values = np.column_stack([result[metric] for metric in self.metrics])
+
+        self.f_A = np.concatenate([self.f_A, values[:n]])
+        self.f_B = np.concatenate([self.f_B, values[n:2 * n]])
+        self.f_AB = np.concatenate([self.f_AB, values[2 * n:].reshape(n_params, n, -1)], axis=1)
+        self.n_samples += n
+        return self
+
+    def indices(self):
+        # Return {metric: {'first_order': {param: S_i}, 'total_effect': {param: ST_i}}}.
+        # Samples where a metric is undefined (e.g. no sleep at all) are left out for that metric.
+        results = {}
+        for m, metric in enumerate(self.metrics):
+            f_A, f_B, f_AB = self.f_A[:, m], self.f_B[:, m], self.f_AB[:, :, m]
+            valid = np.isfinite(f_A) & np.isfinite(f_B) & np.isfinite(f_AB).all(axis=0)
+            f_A, f_B, f_AB = f_A[valid], f_B[valid], f_AB[:, valid]
+            variance = np.var(np.concatenate([f_A, f_B]))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                first_order = np.mean(f_B * (f_AB - f_A), axis=1) / variance
+                total_effect = 0.5 * np.mean((f_A - f_AB) ** 2, axis=1) / variance
+            results[metric] = {
+                'first_order': dict(zip(self.names, first_order)),
+                'total_effect': dict(zip(self.names, total_effect)),
+            }
+        return results
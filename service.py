@@ -0,0 +1,326 @@
+import argparse
+import asyncio
+import json
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from borbely import BorbelyModel
+from config import default_params
+from sleep_metrics import compute_sleep_metrics
+
+# Local simulation service: a small asyncio HTTP/1.1 server (TCP or Unix socket, keep-alive) with two endpoints.
+#   POST /simulate  -> sleep pressure, wake state and switch times of one run
+#   POST /stats     -> compute_sleep_metrics of one run
+# The request body is JSON: {"params": {name: value, ...}, "ts": {"start": 0, "stop": 100, "step": 0.5},
+# "H0": 0.1, "awake0": true, "dtype": "float64" | "float32", "bounds": false}; everything but ts is optional.
+# Requests that arrive within `window` seconds of each other and share a time grid are simulated together
+# in one simulate_batch call on a worker process, so the event loop only parses, batches and writes.
+#
+# Responses are framed binary arrays (content type application/x-borbely-arrays):
+#   4-byte little-endian header length | JSON header | raw array buffers
+# The header lists each array's name, dtype, shape, offset and nbytes (offsets relative to the end of the header)
+# plus plain JSON fields such as metrics. The wake mask is bit-packed (dtype "bitpacked", unpacked to shape).
+# decode_arrays() turns a response body back into a dict; errors are JSON with an "error" field.
+
+CONTENT_TYPE = 'application/x-borbely-arrays'
+
+def encode_arrays(arrays, **fields):
+    # Frame a dict of NumPy arrays (bool arrays are bit-packed) and extra JSON fields.
+    entries, buffers, offset = [], [], 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        entry = {'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        if array.dtype == bool:
+            entry['dtype'] = 'bitpacked'
+            array = np.packbits(array)
+        entry.update(offset=offset, nbytes=array.nbytes)
+        entries.append(entry)
+        buffers.append(array.tobytes())
+        offset += array.nbytes
+    header = json.dumps({**fields, 'arrays': entries}).encode()
+    return b''.join([struct.pack('<I', len(header)), header] + buffers)
+
+def decode_arrays(body):
+    # Inverse of encode_arrays: return the header fields with the arrays added under their names.
+    (header_length,) = struct.unpack_from('<I', body)
+    header = json.loads(body[4:4 + header_length])
+    data = memoryview(body)[4 + header_length:]
+    result = {key: value for key, value in header.items() if key != 'arrays'}
+    for entry in header['arrays']:
+        raw = data[entry['offset']:entry['offset'] + entry['nbytes']]
+        if entry['dtype'] == 'bitpacked':
+            count = int(np.prod(entry['shape']))
+            result[entry['name']] = np.unpackbits(np.frombuffer(raw, dtype=np.uint8), count=count).view(bool).reshape(entry['shape'])
+        else:
+            result[entry['name']] = np.frombuffer(raw, dtype=entry['dtype']).reshape(entry['shape'])
+    return result
+
+# Each worker process builds its model once, as in sweep.py
+_worker_model = None
+
+def _init_worker(base_params):
+    global _worker_model
+    _worker_model = BorbelyModel(base_params)
+
+# Below this many requests, per-run simulate() is faster than the vectorized batch loop
+_SMALL_GROUP = 4
+
+def _warm_up():
+    # No-op run once before the socket is bound, so the pool's workers exist before there is anything to inherit.
+    return None
+
+def _run_group(ts_spec, requests):
+    # Simulate one micro-batch (requests sharing ts_spec) and return one encoded response body per request.
+    ts = np.arange(*ts_spec)
+    want_stats = any(request['kind'] == 'stats' for request in requests)
+    if len(requests) <= _SMALL_GROUP:
+        runs = [BorbelyModel({**_worker_model.params, **request['params']}).simulate(ts, request['H0'], request['awake0']) for request in requests]
+        metrics = [compute_sleep_metrics(run) if want_stats else None for run in runs]
+    else:
+        batch = _worker_model.simulate_batch([request['params'] for request in requests], ts,
+                                             np.array([request['H0'] for request in requests], dtype=float),
+                                             np.array([request['awake0'] for request in requests], dtype=bool))
+        runs = [batch[i] for i in range(len(requests))]
+        batch_metrics = compute_sleep_metrics(batch) if want_stats else {}
+        metrics = [{name: values[i] for name, values in batch_metrics.items()} for i in range(len(requests))]
+
+    bodies = []
+    for request, run, run_metrics in zip(requests, runs, metrics):
+        if request['kind'] == 'stats':
+            bodies.append(encode_arrays({}, metrics={name: float(value) for name, value in run_metrics.items()}))
+            continue
+        arrays = {
+            'H': np.asarray(run.H, dtype=request['dtype']),
+            'awake': run.awake,
+            'sleep_starts': np.array(run.sleep_starts, dtype=float),
+            'sleep_ends': np.array(run.sleep_ends, dtype=float),
+        }
+        if request['bounds']:
+            arrays['upper'] = np.asarray(run.upper, dtype=request['dtype'])
+            arrays['lower'] = np.asarray(run.lower, dtype=request['dtype'])
+        bodies.append(encode_arrays(arrays, ts=list(ts_spec), batch_size=len(requests)))
+    return bodies
+
+class SimulationService:
+    # This class runs the micro-batching queue and the HTTP front end.
+    # At most one batch per worker is in flight: while all workers are busy, new requests wait in the
+    # queue and go out together in the next batch, so batches grow with load instead of queueing up.
+    # submit() can also be awaited directly, without HTTP, from code running on the same event loop.
+    # A custom executor must have run _init_worker(base_params) in its workers.
+    # Time grids longer than max_points are rejected, so one request cannot exhaust a worker's memory.
+    def __init__(self, base_params=None, window=0.002, max_batch=1024, processes=None, executor=None, max_points=1_000_000):
+        self.base_params = default_params if base_params is None else base_params
+        self.window = window
+        self.max_batch = max_batch
+        self.max_points = max_points
+        self.processes = processes or os.cpu_count()
+        self.executor = executor or ProcessPoolExecutor(max_workers=self.processes, initializer=_init_worker, initargs=(self.base_params,))
+        self.queue = None
+        self.server = None
+        self.tasks = set()  # Running _dispatch tasks, referenced so they are not garbage-collected mid-run
+        self.batches = 0
+        self.requests = 0
+
+    def parse_request(self, kind, payload):
+        # Validate a decoded JSON body and fill in the defaults; raises ValueError on bad input.
+        if not isinstance(payload, dict):
+            raise ValueError("The request body must be a JSON object")
+        params = payload.get('params', {})
+        if not isinstance(params, dict) or not isinstance(payload.get('ts', {}), dict):
+            raise ValueError("'params' and 'ts' must be JSON objects")
+        unknown = [name for name in params if name not in self.base_params]
+        if unknown:
+            raise ValueError(f"Unknown parameter(s): {', '.join(unknown)}")
+        if 'ts' not in payload:
+            raise ValueError("Missing 'ts' ({'start', 'stop', 'step'})")
+        ts_spec = (float(payload['ts'].get('start', 0.0)), float(payload['ts']['stop']), float(payload['ts']['step']))
+        if ts_spec[2] <= 0 or ts_spec[1] <= ts_spec[0]:
+            raise ValueError("'ts' must have stop > start and step > 0")
+        if (ts_spec[1] - ts_spec[0]) / ts_spec[2] > self.max_points:
+            raise ValueError(f"'ts' has more than {self.max_points} points")
+        dtype = payload.get('dtype', 'float64')
+        if dtype not in ('float64', 'float32'):
+            raise ValueError("'dtype' must be float64 or float32")
+        return ts_spec, {
+            'kind': kind,
+            'params': {name: float(value) for name, value in params.items()},
+            'H0': float(payload.get('H0', 0.1)),
+            'awake0': bool(payload.get('awake0', True)),
+            'dtype': dtype,
+            'bounds': bool(payload.get('bounds', False)),
+        }
+
+    async def submit(self, kind, payload):
+        # Queue one request and wait for its encoded response body.
+        return await self._enqueue(*self.parse_request(kind, payload))
+
+    async def _enqueue(self, ts_spec, request):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((ts_spec, request, future))
+        return await future
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            await self.slots.acquire()
+            while len(pending) < self.max_batch:
+                try:
+                    pending.append(self.queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            groups = {}
+            for ts_spec, request, future in pending:
+                groups.setdefault(ts_spec, []).append((request, future))
+            for k, (ts_spec, group) in enumerate(groups.items()):
+                if k > 0:
+                    await self.slots.acquire()
+                task = asyncio.create_task(self._dispatch(ts_spec, group))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def _dispatch(self, ts_spec, group):
+        # Run one group on the pool. If the batch fails, its requests are retried one by one,
+        # so only the request that causes the error gets it.
+        self.batches += 1
+        self.requests += len(group)
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                results = await loop.run_in_executor(self.executor, _run_group, ts_spec, [request for request, _ in group])
+            except Exception as error:
+                if len(group) == 1:
+                    results = [error]
+                else:
+                    results = []
+                    for request, _ in group:
+                        try:
+                            results += await loop.run_in_executor(self.executor, _run_group, ts_spec, [request])
+                        except Exception as single_error:
+                            results.append(single_error)
+        finally:
+            self.slots.release()
+        for (_, future), result in zip(group, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _handle_connection(self, reader, writer):
+        # Serve HTTP/1.1 requests on one connection until the client closes it.
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, content_type, response = await self._respond(method, path, body)
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(response)}\r\n\r\n".encode() + response)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, method, path, body):
+        kind = {'/simulate': 'simulate', '/stats': 'stats'}.get(path)
+        if method != 'POST' or kind is None:
+            return '404 Not Found', 'application/json', json.dumps({'error': f"No endpoint {method} {path}"}).encode()
+        try:
+            ts_spec, request = self.parse_request(kind, json.loads(body or b'{}'))
+        except (ValueError, KeyError, TypeError) as error:
+            return '400 Bad Request', 'application/json', json.dumps({'error': str(error)}).encode()
+        try:
+            return '200 OK', CONTENT_TYPE, await self._enqueue(ts_spec, request)
+        except Exception as error:
+            return '500 Internal Server Error', 'application/json', json.dumps({'error': f"{type(error).__name__}: {error}"}).encode()
+
+    async def start(self, host='127.0.0.1', port=8765, unix_path=None):
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.processes)
+        self._batcher_task = asyncio.create_task(self._batcher())
+        # Start the workers before binding: forked workers would otherwise inherit the listening socket and
+        # open client connections, and a client closing its connection would never see EOF. With the fork
+        # start method all max_workers processes are created on the first submit.
+        await asyncio.get_running_loop().run_in_executor(self.executor, _warm_up)
+        if unix_path is not None:
+            self.server = await asyncio.start_unix_server(self._handle_connection, path=unix_path)
+        else:
+            self.server = await asyncio.start_server(self._handle_connection, host, port)
+        return self.server
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self._batcher_task.cancel()
+        # shutdown waits for running batches, so keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+async def request(path, payload, host='127.0.0.1', port=8765, unix_path=None):
+    # Minimal client for notebooks and tests: POST payload to path and return the decoded response.
+    if unix_path is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode()
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+    await writer.drain()
+
+    status = (await reader.readline()).decode('latin-1').split(' ', 2)[1]
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b''):
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    response = await reader.readexactly(int(headers['content-length']))
+    writer.close()
+
+    if status != '200':
+        raise RuntimeError(json.loads(response)['error'])
+    return decode_arrays(response)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve Borbely simulations over local HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help='listen on this Unix socket path instead of TCP')
+    parser.add_argument('--window-ms', type=float, default=2.0, help='micro-batching window')
+    parser.add_argument('--max-batch', type=int, default=1024)
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args(argv)
+
+    async def serve():
+        service = SimulationService(window=args.window_ms / 1000, max_batch=args.max_batch, processes=args.processes)
+        server = await service.start(args.host, args.port, args.unix)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import numpy as np
+
+# Sleep metrics for single SleepData runs or (N, T) batches, computed in one pass over the trajectories.
+# Time spent in a state is attributed per step from the state at the start of the step.
+# Onset/offset phases are clock times (hours modulo the circadian period), averaged on the circle.
+
+def _as_rows(sleep_data):
+    # Return (time, H, awake, upper) with H/awake/upper as (N, T) arrays.
+    H = np.atleast_2d(np.asarray(sleep_data.H, dtype=float))
+    awake = np.atleast_2d(np.asarray(sleep_data.awake, dtype=bool))
+    upper = np.broadcast_to(np.asarray(sleep_data.upper, dtype=float), H.shape)
+    return np.asarray(sleep_data.time, dtype=float), H, awake, upper
+
+def _chunk_events(time, H, awake, upper, open_start):
+    # One pass over an (N, T) chunk: per-row totals, the onset/offset events, and the completed episode durations.
+    # open_start holds, per row, the onset time of an episode begun in an earlier chunk (nan if none).
+    dt = np.diff(time)
+    asleep = ~awake[:, :-1]
+
+    falls_asleep = awake[:, :-1] & ~awake[:, 1:]
+    wakes_up = ~awake[:, :-1] & awake[:, 1:]
+    onset_rows, onset_cols = np.nonzero(falls_asleep)
+    offset_rows, offset_cols = np.nonzero(wakes_up)
+
+    # Transitions alternate within a row, so each offset closes the transition before it in the same row,
+    # or the episode carried in from the previous chunk if it is the first transition of its row.
+    rows, cols = np.nonzero(falls_asleep | wakes_up)
+    is_offset = awake[rows, cols + 1]
+    first_in_row = np.ones(len(rows), dtype=bool)
+    first_in_row[1:] = rows[1:] != rows[:-1]
+    previous_time = np.empty(len(rows))
+    previous_time[1:] = time[cols[:-1] + 1]
+    previous_time[first_in_row] = open_start[rows[first_in_row]]
+    durations = time[cols[is_offset] + 1] - previous_time[is_offset]
+    duration_rows = rows[is_offset]
+    complete = ~np.isnan(durations)
+
+    # Carry the episodes that are still open at the end of the chunk
+    new_open_start = np.where(awake[:, -1], np.nan, open_start)
+    last_in_row = np.ones(len(rows), dtype=bool)
+    last_in_row[:-1] = rows[:-1] != rows[1:]
+    last_onsets = last_in_row & ~is_offset
+    new_open_start[rows[last_onsets]] = time[cols[last_onsets] + 1]
+
+    return {
+        'total_hours': np.full(len(H), dt.sum()),
+        'sleep_hours': (asleep * dt).sum(axis=1),
+        'above_upper_hours': ((H[:, :-1] > upper[:, :-1]) * dt).sum(axis=1),
+        'onset_rows': onset_rows,
+        'onset_times': time[onset_cols + 1],
+        'onset_H': H[onset_rows, onset_cols + 1],
+        'offset_rows': offset_rows,
+        'offset_times': time[offset_cols + 1],
+        'duration_rows': duration_rows[complete],
+        'durations': durations[complete],
+    }, new_open_start
+
+def _circular_mean_hours(sin_sum, cos_sum, period):
+    return np.mod(np.arctan2(sin_sum, cos_sum) * period / (2 * np.pi), period)
+
+def compute_sleep_metrics(sleep_data, period=24.0):
+    # Compute the sleep metrics of every row of a SleepData (scalars) or BatchSleepData ((N,) arrays).
+    time, H, awake, upper = _as_rows(sleep_data)
+    n_rows = len(H)
+    events, _ = _chunk_events(time, H, awake, upper, np.full(n_rows, np.nan))
+
+    def per_row(rows, values=None):
+        return np.bincount(rows, weights=values, minlength=n_rows)
+
+    n_onsets = per_row(events['onset_rows'])
+    n_offsets = per_row(events['offset_rows'])
+    n_episodes = per_row(events['duration_rows'])
+    onset_angles = 2 * np.pi * events['onset_times'] / period
+    offset_angles = 2 * np.pi * events['offset_times'] / period
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        metrics = {
+            'total_sleep_hours': events['sleep_hours'],
+            'sleep_hours_per_day': events['sleep_hours'] / events['total_hours'] * period,
+            'episodes_per_day': n_onsets / events['total_hours'] * period,
+            'mean_episode_duration': per_row(events['duration_rows'], events['durations']) / n_episodes,
+            'onset_phase': np.where(n_onsets > 0, _circular_mean_hours(per_row(events['onset_rows'], np.sin(onset_angles)), per_row(events['onset_rows'], np.cos(onset_angles)), period), np.nan),
+            'offset_phase': np.where(n_offsets > 0, _circular_mean_hours(per_row(events['offset_rows'], np.sin(offset_angles)), per_row(events['offset_rows'], np.cos(offset_angles)), period), np.nan),
+            'mean_H_at_onset': per_row(events['onset_rows'], events['onset_H']) / n_onsets,
+            'time_above_upper': events['above_upper_hours'],
+            'n_sleep_episodes': n_onsets.astype(int),
+        }
+
+    if np.ndim(sleep_data.H) == 1:
+        return {name: value[0].item() for name, value in metrics.items()}
+    return metrics
+
+def _merge_moments(a, b):
+    # Chan et al. parallel combination of (count, mean, M2) accumulators.
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n == 0:
+        return 0, 0.0, 0.0
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n
+
+def _moments(values):
+    if len(values) == 0:
+        return 0, 0.0, 0.0
+    mean = values.mean()
+    return len(values), mean, ((values - mean) ** 2).sum()
+
+class SleepMetricsAccumulator:
+    # This class accumulates pooled sleep metrics without keeping trajectories around.
+    # update() consumes consecutive chunks of the same run(s), e.g. from BorbelyModel.iter_simulate,
+    # carrying the state across chunk boundaries. merge() combines accumulators of independent
+    # workers, with Welford/Chan moments for the per-episode quantities.
+    def __init__(self, period=24.0):
+        self.period = period
+        self.total_hours = 0.0
+        self.sleep_hours = 0.0
+        self.above_upper_hours = 0.0
+        self.n_onsets = 0
+        self.n_offsets = 0
+        self.onset_sin = self.onset_cos = 0.0
+        self.offset_sin = self.offset_cos = 0.0
+        self.duration_moments = (0, 0.0, 0.0)
+        self.onset_H_moments = (0, 0.0, 0.0)
+        self._carry = None
+
+    def update(self, sleep_data):
+        # Add the next chunk of a SleepData/BatchSleepData stream.
+        time, H, awake, upper = _as_rows(sleep_data)
+        if self._carry is None:
+            open_start = np.full(len(H), np.nan)
+        else:
+            # Prepend the last sample of the previous chunk so the step across the boundary is counted
+            last_time, last_H, last_awake, last_upper, open_start = self._carry
+            time = np.concatenate([[last_time], time])
+            H = np.concatenate([last_H[:, None], H], axis=1)
+            awake = np.concatenate([last_awake[:, None], awake], axis=1)
+            upper = np.concatenate([last_upper[:, None], upper], axis=1)
+
+        events, open_start = _chunk_events(time, H, awake, upper, open_start)
+        self._carry = (time[-1], H[:, -1], awake[:, -1], upper[:, -1], open_start)
+
+        self.total_hours += events['total_hours'].sum()
+        self.sleep_hours += events['sleep_hours'].sum()
+        self.above_upper_hours += events['above_upper_hours'].sum()
+        self.n_onsets += len(events['onset_times'])
+        self.n_offsets += len(events['offset_times'])
+        onset_angles = 2 * np.pi * events['onset_times'] / self.period
+        offset_angles = 2 * np.pi * events['offset_times'] / self.period
+        self.onset_sin += np.sin(onset_angles).sum()
+        self.onset_cos += np.cos(onset_angles).sum()
+        self.offset_sin += np.sin(offset_angles).sum()
+        self.offset_cos += np.cos(offset_angles).sum()
+        self.duration_moments = _merge_moments(self.duration_moments, _moments(events['durations']))
+        self.onset_H_moments = _merge_moments(self.onset_H_moments, _moments(events['onset_H']))
+        return self
+
+    def merge(self, other):
+        # Combine with an accumulator that saw other subjects (or a later, independent stretch of time).
+        for name in ('total_hours', 'sleep_hours', 'above_upper_hours', 'n_onsets', 'n_offsets', 'onset_sin', 'onset_cos', 'offset_sin', 'offset_cos'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.duration_moments = _merge_moments(self.duration_moments, other.duration_moments)
+        self.onset_H_moments = _merge_moments(self.onset_H_moments, other.onset_H_moments)
+        return self
+
+    def result(self):
+        # Return the pooled metrics as a dict of floats.
+        def std(moments):
+            return np.sqrt(moments[2] / (moments[0] - 1)) if moments[0] > 1 else np.nan
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {
+                'sleep_hours_per_day': self.sleep_hours / self.total_hours * self.period,
+                'episodes_per_day': self.n_onsets / self.total_hours * self.period,
+                'mean_episode_duration': self.duration_moments[1] if self.duration_moments[0] else np.nan,
+                'std_episode_duration': std(self.duration_moments),
+                'onset_phase': _circular_mean_hours(self.onset_sin, self.onset_cos, self.period) if self.n_onsets else np.nan,
+                'offset_phase': _circular_mean_hours(self.offset_sin, self.offset_cos, self.period) if self.n_offsets else np.nan,
+                'mean_H_at_onset': self.onset_H_moments[1] if self.onset_H_moments[0] else np.nan,
+                'std_H_at_onset': std(self.onset_H_moments),
+                'fraction_above_upper': self.above_upper_hours / self.total_hours,
+                'n_sleep_episodes': self.n_onsets,
+            }
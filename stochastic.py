@@ -0,0 +1,172 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from borbely import BatchSleepData, BorbelyModel
+from instrumentation import metrics
+
+# Stochastic Monte Carlo version of the Borbely model.
+# Three noise sources can be switched on independently:
+#   threshold_noise    standard deviation of Gaussian noise added to the upper/lower bounds at every step
+#   decay_jitter       log-normal spread of Sleep_Decay_Rate and Wake_Decay_Rate, drawn once per replicate
+#   interruption_rate  rate (per hour) of random awakenings while asleep
+# Ensembles are simulated in fixed-size blocks. Block k always draws from the k-th child of
+# SeedSequence(seed).spawn(), and blocks are reduced to histograms and merged in block order, so the
+# result is bit-for-bit the same for any number of worker processes.
+
+class StochasticBorbelyModel(BorbelyModel):
+    def __init__(self, params=None, threshold_noise=0.0, decay_jitter=0.0, interruption_rate=0.0):
+        super().__init__(params)
+        self.threshold_noise = threshold_noise
+        self.decay_jitter = decay_jitter
+        self.interruption_rate = interruption_rate
+
+    def _replicate_params(self, n_replicates, rng):
+        # Per-replicate parameter arrays, shape (N,), with jittered decay rates.
+        params = {key: np.full(n_replicates, value, dtype=float) for key, value in self.params.items() if not isinstance(value, str)}
+        if self.decay_jitter:
+            params['Sleep_Decay_Rate'] *= np.exp(self.decay_jitter * rng.standard_normal(n_replicates))
+            params['Wake_Decay_Rate'] *= np.exp(self.decay_jitter * rng.standard_normal(n_replicates))
+        return params
+
+    def _integrate_replicates(self, ts, H0, awake0, n_replicates, rng):
+        # Simulate n_replicates noisy trajectories together; returns (params, H, awake, upper, lower).
+        # Draws happen in a fixed order (per-replicate rates, then per step), so a given rng state
+        # always produces the same trajectories.
+        params = self._replicate_params(n_replicates, rng)
+        upper = self.process_c.calculate_upper_bound(ts)
+        lower = self.process_c.calculate_lower_bound(ts)
+
+        H = np.empty((n_replicates, len(ts)))
+        H[:, 0] = H0
+        awake = np.empty((n_replicates, len(ts)), dtype=bool)
+        awake[:, 0] = awake0
+
+        wake_baseline = self.params['Wake_Baseline_Pressure']
+        wake_decay_rate = params['Wake_Decay_Rate']
+        sleep_decay_rate = params['Sleep_Decay_Rate']
+
+        with metrics.phase('integration'):
+            for i in range(1, len(ts)):
+                dt = ts[i] - ts[i-1]
+                H_wake = wake_baseline + (H[:, i-1] - wake_baseline) * np.exp(-dt / wake_decay_rate)
+                H_sleep = H[:, i-1] * np.exp(-dt / sleep_decay_rate)
+                H[:, i] = np.where(awake[:, i-1], H_wake, H_sleep)
+
+                upper_i, lower_i = upper[i], lower[i]
+                if self.threshold_noise:
+                    noise = self.threshold_noise * rng.standard_normal((2, n_replicates))
+                    upper_i, lower_i = upper_i + noise[0], lower_i + noise[1]
+
+                falls_asleep = awake[:, i-1] & (H[:, i] >= upper_i)
+                wakes_up = ~awake[:, i-1] & (H[:, i] <= lower_i)
+                if self.interruption_rate:
+                    wakes_up |= ~awake[:, i-1] & (rng.random(n_replicates) < -np.expm1(-self.interruption_rate * dt))
+                awake[:, i] = (awake[:, i-1] & ~falls_asleep) | wakes_up
+        metrics.count('simulations', n_replicates)
+        metrics.count('steps', n_replicates * len(ts))
+
+        return params, H, awake, upper, lower
+
+    def simulate_replicates(self, ts, sleep_pressure_T0, wake_status_T0=False, n_replicates=1, seed=None):
+        # Simulate n_replicates noisy runs in one vectorized call and keep all of them, as BatchSleepData.
+        ts = np.asarray(ts, dtype=float)
+        rng = np.random.default_rng(seed)
+        params, H, awake, upper, lower = self._integrate_replicates(ts, sleep_pressure_T0, wake_status_T0, n_replicates, rng)
+        shape = (n_replicates, len(ts))
+        return BatchSleepData(ts, H, awake, np.broadcast_to(upper, shape), np.broadcast_to(lower, shape), params)
+
+    def ensemble(self, ts, sleep_pressure_T0, wake_status_T0=False, n_replicates=1000, seed=None,
+                 block_size=256, processes=1, H_bins=200, max_onsets=32):
+        # Simulate n_replicates runs in blocks of block_size and return only their EnsembleResult histograms.
+        # processes=1 runs serially in this process; None uses all cores. The result does not depend on processes.
+        ts = np.asarray(ts, dtype=float)
+        H_edges = np.linspace(0.0, max(self.params['Wake_Baseline_Pressure'], sleep_pressure_T0), H_bins + 1)
+        sizes = [min(block_size, n_replicates - first) for first in range(0, n_replicates, block_size)]
+        children = np.random.SeedSequence(seed).spawn(len(sizes))
+        settings = (self.params, self.threshold_noise, self.decay_jitter, self.interruption_rate)
+        args = [(settings, ts, sleep_pressure_T0, wake_status_T0, size, child, H_edges, max_onsets) for size, child in zip(sizes, children)]
+
+        if processes == 1:
+            blocks = [_run_block(*block_args) for block_args in args]
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                blocks = list(executor.map(_run_block, *zip(*args)))
+
+        result = EnsembleResult(ts, H_edges, max_onsets)
+        for block in blocks:
+            result.merge(*block)
+        return result
+
+def _run_block(settings, ts, sleep_pressure_T0, wake_status_T0, n_replicates, seed_sequence, H_edges, max_onsets):
+    # Simulate one block and reduce it to (replicates, H counts, H sum, onset counts).
+    params, threshold_noise, decay_jitter, interruption_rate = settings
+    model = StochasticBorbelyModel(params, threshold_noise, decay_jitter, interruption_rate)
+    _, H, awake, _, _ = model._integrate_replicates(ts, sleep_pressure_T0, wake_status_T0, n_replicates, np.random.default_rng(seed_sequence))
+    n_steps = len(ts)
+
+    # Histogram of H at every time step, counted in one bincount over (step, bin) pairs
+    H_bins = len(H_edges) - 1
+    bins = np.clip(np.searchsorted(H_edges, H, side='right') - 1, 0, H_bins - 1)
+    H_counts = np.bincount((np.arange(n_steps) * H_bins + bins).ravel(), minlength=n_steps * H_bins).reshape(n_steps, H_bins)
+
+    # The k-th sleep onset of every replicate, counted by the time step it happens at
+    falls_asleep = np.zeros_like(awake)
+    falls_asleep[:, 1:] = awake[:, :-1] & ~awake[:, 1:]
+    rank = np.cumsum(falls_asleep, axis=1) - 1
+    keep = falls_asleep & (rank < max_onsets)
+    step = np.broadcast_to(np.arange(n_steps), awake.shape)
+    onset_counts = np.bincount((rank[keep] * n_steps + step[keep]), minlength=max_onsets * n_steps).reshape(max_onsets, n_steps)
+
+    return n_replicates, H_counts, H.sum(axis=0), onset_counts
+
+class EnsembleResult:
+    # This class holds an ensemble reduced to per-step histograms, so its size does not grow with the
+    # number of replicates: H counts per (step, H bin), the per-step sum of H, and counts of the k-th
+    # sleep onset per (k, step). Sleep onsets fall on the ts grid, so their quantiles are exact;
+    # H quantiles are interpolated within a bin, i.e. accurate to the bin width.
+    def __init__(self, ts, H_edges, max_onsets):
+        self.ts = ts
+        self.H_edges = H_edges
+        self.n_replicates = 0
+        self.H_counts = np.zeros((len(ts), len(H_edges) - 1), dtype=np.int64)
+        self.H_sum = np.zeros(len(ts))
+        self.onset_counts = np.zeros((max_onsets, len(ts)), dtype=np.int64)
+
+    def merge(self, n_replicates, H_counts, H_sum, onset_counts):
+        self.n_replicates += n_replicates
+        self.H_counts += H_counts
+        self.H_sum += H_sum
+        self.onset_counts += onset_counts
+        return self
+
+    def H_mean(self):
+        return self.H_sum / self.n_replicates
+
+    def H_quantiles(self, quantiles=(0.05, 0.5, 0.95)):
+        # Quantiles of H at every time step, shape (len(quantiles), T).
+        cumulative = np.cumsum(self.H_counts, axis=1)
+        result = np.empty((len(quantiles), len(self.ts)))
+        for j, q in enumerate(quantiles):
+            target = q * self.n_replicates
+            b = np.minimum((cumulative < target).sum(axis=1), cumulative.shape[1] - 1)
+            steps = np.arange(len(self.ts))
+            below = np.where(b > 0, cumulative[steps, np.maximum(b - 1, 0)], 0)
+            fraction = np.clip((target - below) / np.maximum(self.H_counts[steps, b], 1), 0, 1)
+            result[j] = self.H_edges[b] + fraction * (self.H_edges[b + 1] - self.H_edges[b])
+        return result
+
+    def onset_fraction(self):
+        # Fraction of replicates that reach a k-th sleep onset, shape (max_onsets,).
+        return self.onset_counts.sum(axis=1) / self.n_replicates
+
+    def onset_quantiles(self, quantiles=(0.05, 0.5, 0.95)):
+        # Quantiles of the time of the k-th sleep onset among the replicates that have one,
+        # shape (max_onsets, len(quantiles)); NaN where no replicate gets that far.
+        cumulative = np.cumsum(self.onset_counts, axis=1)
+        totals = cumulative[:, -1:]
+        result = np.full((len(self.onset_counts), len(quantiles)), np.nan)
+        for j, q in enumerate(quantiles):
+            index = np.minimum((cumulative < np.maximum(q * totals, 1)).sum(axis=1), len(self.ts) - 1)
+            result[:, j] = np.where(totals[:, 0] > 0, self.ts[index], np.nan)
+        return result
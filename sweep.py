@@ -0,0 +1,149 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from borbely import BorbelyModel
+from config import default_params
+from sleep_metrics import compute_sleep_metrics
+
+def parameter_grid(grid):
+    # Expand a dict of parameter name -> list of values into the list of all combinations (cartesian product).
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+def print_progress(done, total, file=None):
+    # Progress callback that prints how many parameter sets have been simulated (to stdout unless file is given).
+    print(f"Sweep progress: {done}/{total} ({100 * done / total:.1f}%)", file=file)
+
+# Each worker process builds its model once and reuses it for every chunk it is given
+_worker_model = None
+
+def _init_worker(base_params):
+    global _worker_model
+    _worker_model = BorbelyModel(base_params)
+
+def _run_chunk(first, overrides, ts, sleep_pressure_T0, wake_status_T0):
+    # Simulate one chunk of the sweep in a single batch and reduce it to columns.
+    batch = _worker_model.simulate_batch(overrides, ts, sleep_pressure_T0, wake_status_T0)
+
+    first_sleep_start = np.array([starts[0] if starts else np.nan for starts in batch.sleep_starts])
+
+    columns = {
+        **batch.params,
+        **compute_sleep_metrics(batch),
+        'first_sleep_start': first_sleep_start,
+    }
+    return first, columns, batch.sleep_starts, batch.sleep_ends
+
+def _chunk_path(checkpoint_dir, first, size):
+    return os.path.join(checkpoint_dir, f"chunk_{first}_{size}.npz")
+
+def _save_chunk(path, result):
+    # Save one chunk result; written to a temporary file first so an interruption never leaves a partial chunk.
+    first, columns, sleep_starts, sleep_ends = result
+    arrays = {'col_' + name: values for name, values in columns.items()}
+    for name, times in (('sleep_starts', sleep_starts), ('sleep_ends', sleep_ends)):
+        arrays[name] = np.array([t for row in times for t in row], dtype=float)
+        arrays[name + '_offsets'] = np.concatenate([[0], np.cumsum([len(row) for row in times])])
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, first=first, **arrays)
+    os.replace(path + '.tmp', path)
+
+def _load_chunk(path):
+    with np.load(path) as archive:
+        columns = {name[4:]: archive[name] for name in archive.files if name.startswith('col_')}
+        switch_times = []
+        for name in ('sleep_starts', 'sleep_ends'):
+            times, offsets = archive[name], archive[name + '_offsets']
+            switch_times.append([list(times[offsets[i]:offsets[i+1]]) for i in range(len(offsets) - 1)])
+        return int(archive['first']), columns, switch_times[0], switch_times[1]
+
+class SweepResult:
+    # This class holds a sweep as one columnar table: one row per parameter set.
+    # Switch times are ragged, so they are stored flat with offsets: row i owns sleep_starts[starts_offsets[i]:starts_offsets[i+1]].
+    def __init__(self, columns, sleep_starts, starts_offsets, sleep_ends, ends_offsets):
+        self.columns = columns
+        self.sleep_starts = sleep_starts
+        self.starts_offsets = starts_offsets
+        self.sleep_ends = sleep_ends
+        self.ends_offsets = ends_offsets
+
+    def __len__(self):
+        return len(self.starts_offsets) - 1
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def switch_times(self, i):
+        # Return the (sleep_starts, sleep_ends) of row i.
+        return (self.sleep_starts[self.starts_offsets[i]:self.starts_offsets[i+1]],
+                self.sleep_ends[self.ends_offsets[i]:self.ends_offsets[i+1]])
+
+class ParameterSweep:
+    # This class runs many parameter overrides on top of the base parameters, split into chunks
+    # that are simulated in batches across a process pool. Results do not depend on the chunking.
+    def __init__(self, overrides, base_params=None, chunk_size=1000):
+        if isinstance(overrides, dict):
+            overrides = parameter_grid(overrides)
+        self.overrides = list(overrides)
+        self.base_params = default_params if base_params is None else base_params
+        self.chunk_size = chunk_size
+
+    def _chunks(self):
+        for first in range(0, len(self.overrides), self.chunk_size):
+            yield first, self.overrides[first:first + self.chunk_size]
+
+    def run(self, ts, sleep_pressure_T0, wake_status_T0=False, processes=None, progress=None, checkpoint_dir=None):
+        # Simulate every parameter set. processes=1 runs serially in this process; None uses all cores.
+        # progress, if given, is called as progress(done, total) after each chunk.
+        # With checkpoint_dir (one directory per sweep), every finished chunk is saved there and chunks
+        # already saved by an earlier, interrupted run are loaded instead of simulated again.
+        ts = np.asarray(ts, dtype=float)
+        results = []
+        done = 0
+
+        chunks = list(self._chunks())
+        if checkpoint_dir is not None:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            saved = [(first, overrides) for first, overrides in chunks if os.path.exists(_chunk_path(checkpoint_dir, first, len(overrides)))]
+            for first, overrides in saved:
+                results.append(_load_chunk(_chunk_path(checkpoint_dir, first, len(overrides))))
+                done += len(overrides)
+            chunks = [chunk for chunk in chunks if chunk not in saved]
+
+        def finished(result):
+            nonlocal done
+            results.append(result)
+            if checkpoint_dir is not None:
+                _save_chunk(_chunk_path(checkpoint_dir, result[0], len(result[2])), result)
+            done += len(result[2])
+            if progress is not None:
+                progress(done, len(self.overrides))
+
+        if processes == 1:
+            _init_worker(self.base_params)
+            for first, overrides in chunks:
+                finished(_run_chunk(first, overrides, ts, sleep_pressure_T0, wake_status_T0))
+        else:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(self.base_params,)) as executor:
+                futures = [executor.submit(_run_chunk, first, overrides, ts, sleep_pressure_T0, wake_status_T0) for first, overrides in chunks]
+                for future in as_completed(futures):
+                    finished(future.result())
+
+        return self._collect(sorted(results, key=lambda result: result[0]))
+
+    @staticmethod
+    def _collect(results):
+        # Concatenate the per-chunk columns and flatten the switch times in sweep order.
+        columns = {name: np.concatenate([result[1][name] for result in results]) for name in results[0][1]}
+        sleep_starts = [starts for result in results for starts in result[2]]
+        sleep_ends = [ends for result in results for ends in result[3]]
+
+        starts_offsets = np.concatenate([[0], np.cumsum([len(starts) for starts in sleep_starts])])
+        ends_offsets = np.concatenate([[0], np.cumsum([len(ends) for ends in sleep_ends])])
+        flat_starts = np.array([t for starts in sleep_starts for t in starts], dtype=float)
+        flat_ends = np.array([t for ends in sleep_ends for t in ends], dtype=float)
+
+        return SweepResult(columns, flat_starts, starts_offsets, flat_ends, ends_offsets)
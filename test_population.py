@@ -0,0 +1,29 @@
+import numpy as np
+
+from borbely import BorbelyModel, check_population, validate_population
+
+def _mixed_table(n_subjects=60, seed=0):
+    # Subjects that differ in their decay rates and share a few circadian parameter sets
+    rng = np.random.default_rng(seed)
+    return {
+        'Sleep_Decay_Rate': rng.uniform(2.0, 6.0, n_subjects),
+        'Wake_Decay_Rate': rng.uniform(12.0, 25.0, n_subjects),
+        'circadian_amplitude': rng.choice([0.05, 0.1, 0.15], n_subjects),
+        'circadian_phase_shift': rng.choice([0.0, 1.0], n_subjects),
+    }
+
+def test_float64_population_is_bit_exact():
+    report = validate_population(BorbelyModel(), _mixed_table(), np.arange(0, 24 * 10, 0.1), 0.1, True, np.float64)
+    assert report['max_H_error'] == 0
+    assert report['mismatched_step_fraction'] == 0
+
+def test_float32_error_within_bound_on_uniform_grid():
+    report = check_population(BorbelyModel(), _mixed_table(), np.arange(0, 24 * 10, 0.1), 0.1, True)
+    assert report['max_H_error_same_state'] <= report['H_error_bound']
+
+def test_float32_error_within_bound_on_nonuniform_grid():
+    # The bound must use the smallest step, whose decay factor is the largest
+    steps = np.random.default_rng(1).choice([0.02, 0.1, 0.4], 2000)
+    ts = np.concatenate([[0.0], np.cumsum(steps)])
+    report = check_population(BorbelyModel(), _mixed_table(), ts, 0.1, True)
+    assert report['max_H_error_same_state'] <= report['H_error_bound']
@@ -2,17 +2,52 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from matplotlib.lines import Line2D
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.figure import Figure
+from concurrent.futures import ProcessPoolExecutor
+import os
 
 from borbely import BorbelyModel
 from config import configurations, default_params
+from sleep_metrics import compute_sleep_metrics
+from instrumentation import metrics
+
+def _nearest_indices(ts_days, times):
+    # Index of the sample nearest to each time, like np.abs(ts_days - t).argmin() but O(log T) per time.
+    times = np.asarray(times, dtype=float)
+    idx = np.clip(np.searchsorted(ts_days, times), 1, len(ts_days) - 1)
+    return np.where(times - ts_days[idx - 1] <= ts_days[idx] - times, idx - 1, idx)
+
+def _minmax_decimate(ts_days, values, n_bins):
+    # Reduce a curve to the min and max of each of n_bins equal-count bins, in time order,
+    # which keeps its visual envelope at a given pixel width.
+    n_bins = int(n_bins)
+    if len(ts_days) <= 2 * n_bins:
+        return ts_days, values
+    edges = np.linspace(0, len(ts_days), n_bins + 1).astype(int)
+    # Bins differ in length by at most one, so view them as rows of a (n_bins, longest) index matrix,
+    # padding shorter rows with their own last sample (argmin/argmax return the first occurrence)
+    offsets = np.arange(np.diff(edges).max())
+    bin_idx = np.minimum(edges[:-1, None] + offsets, edges[1:, None] - 1)
+    binned = values[bin_idx]
+    lo_idx = bin_idx[np.arange(n_bins), binned.argmin(axis=1)]
+    hi_idx = bin_idx[np.arange(n_bins), binned.argmax(axis=1)]
+    first = np.minimum(lo_idx, hi_idx)
+    second = np.maximum(lo_idx, hi_idx)
+    order = np.column_stack([first, second]).ravel()
+    return ts_days[order], values[order]
 
 class SleepWakeCyclePlotter:
-    def __init__(self, plot_vertical_dashed_lines=True, plot_dots_at_sleep_starts_ends=True, plot_sleep_awake_bars=True):
+    def __init__(self, plot_vertical_dashed_lines=True, plot_dots_at_sleep_starts_ends=True, plot_sleep_awake_bars=True, fast=False):
         self.plot_vertical_dashed_lines = plot_vertical_dashed_lines
         self.plot_dots_at_sleep_starts_ends = plot_dots_at_sleep_starts_ends
         self.plot_sleep_awake_bars = plot_sleep_awake_bars
+        self.fast = fast  # Draw all episodes as single collection artists instead of one artist per episode
 
     def plot(self, ts_days, sleep_starts, sleep_ends, sol, ax):
+        if self.fast:
+            self._plot_fast(ts_days, sleep_starts, sleep_ends, sol, ax)
+            return
         if self.plot_vertical_dashed_lines:
             self._plot_vertical_dashed_lines(ts_days, sleep_starts, sleep_ends, sol, ax)
         if self.plot_dots_at_sleep_starts_ends:
@@ -57,23 +92,57 @@ class SleepWakeCyclePlotter:
 
         return red_patch, green_patch
 
+    def _plot_fast(self, ts_days, sleep_starts, sleep_ends, sol, ax):
+        # Same picture as the per-episode methods, drawn with one artist per element type.
+        ts_days = np.asarray(ts_days)
+        n_periods = min(len(sleep_starts), len(sleep_ends))
+        start_idx = _nearest_indices(ts_days, sleep_starts[:n_periods])
+        end_idx = _nearest_indices(ts_days, sleep_ends[:n_periods])
+        upper = np.asarray(sol.upper)
+        lower = np.asarray(sol.lower)
+
+        if self.plot_vertical_dashed_lines:
+            start_lines = [[(t, 0), (t, y)] for t, y in zip(ts_days[start_idx], upper[start_idx])]
+            end_lines = [[(t, 0), (t, y)] for t, y in zip(ts_days[end_idx], lower[end_idx])]
+            ax.add_collection(LineCollection(start_lines, colors='red', linestyles='--', alpha=0.5))
+            ax.add_collection(LineCollection(end_lines, colors='green', linestyles='--', alpha=0.5))
+
+        if self.plot_dots_at_sleep_starts_ends:
+            ax.plot(ts_days[start_idx], upper[start_idx], 'ro')
+            ax.plot(ts_days[end_idx], lower[end_idx], 'go')
+
+        if self.plot_sleep_awake_bars:
+            ax.fill_between(ts_days[[0, -1]], 0, 0.02, color='green', alpha=0.5)
+            # fill_between over ts_days[start_idx:end_idx] spans up to the sample before end_idx
+            bar_ends = ts_days[np.maximum(end_idx - 1, start_idx)]
+            bars = [[(t0, 0), (t1, 0), (t1, 0.02), (t0, 0.02)] for t0, t1 in zip(ts_days[start_idx], bar_ends)]
+            ax.add_collection(PolyCollection(bars, facecolors='red', alpha=0.5, edgecolors='none'))
+
 class CircadianProcessPlotter:
-    @staticmethod
-    def plot(sleep_data, ax):
+    def __init__(self, decimate=False):
+        self.decimate = decimate  # Min/max downsample the curves to the pixel width of the axes
+
+    def plot(self, sleep_data, ax):
         ts_days = sleep_data.time
-        ax.plot(ts_days, sleep_data.H, label='Homeostatic Process - Sleep Pressure')
 
         # Calculate the circadian rhythm
         circadian_rhythm = sleep_data.calculate_circadian_rhythm(ts_days)
-        ax.plot(ts_days, circadian_rhythm, label='Circadian Process')
 
-        ax.plot(ts_days, sleep_data.lower, 'g--', label='Lower Sleep Bound')
-        ax.plot(ts_days, sleep_data.upper, 'r--', label='Upper Sleep Bound')
+        curves = [
+            (sleep_data.H, {'label': 'Homeostatic Process - Sleep Pressure'}),
+            (circadian_rhythm, {'label': 'Circadian Process'}),
+            (sleep_data.lower, {'fmt': 'g--', 'label': 'Lower Sleep Bound'}),
+            (sleep_data.upper, {'fmt': 'r--', 'label': 'Upper Sleep Bound'}),
+        ]
+        n_bins = ax.get_window_extent().width if self.decimate else None
+        for values, style in curves:
+            t, y = (ts_days, values) if n_bins is None else _minmax_decimate(np.asarray(ts_days), np.asarray(values), n_bins)
+            ax.plot(t, y, *[style['fmt']] if 'fmt' in style else [], label=style['label'])
 
         # Removed the call to SleepWakeCyclePlotter.plot_sleep_periods
 
         max_hours = int(np.ceil(sleep_data.time[-1]))
-        tick_locations = np.arange(0, max_hours + 1, 24)
+        tick_locations = np.arange(0, max_hours + 1, 24 * max(1, int(np.ceil(max_hours / 24 / 20))))  # Daily ticks, at most ~20
         ax.set_xticks(tick_locations)
 
         ax.set_xlim(left=0)
@@ -86,27 +155,34 @@ class CircadianProcessPlotter:
 class StatisticalAnalysisPlotter:
     @staticmethod
     def calculate_statistics(sleep_data):
-        # Add code here to calculate statistics like average sleep duration, standard deviation, etc.
-        # Return the results as a dictionary or a custom data structure
-        pass
+        # Calculate the sleep metrics of a SleepData (floats) or an (N, T) batch (arrays of shape (N,)).
+        return compute_sleep_metrics(sleep_data)
 
     @staticmethod
     def plot_statistics(statistics, ax):
-        # Add code here to plot the calculated statistics
-        pass
+        # Summarize the main metrics in a text box in the corner of the subplot.
+        lines = [
+            f"Sleep/day: {statistics['sleep_hours_per_day']:.1f} h",
+            f"Episodes/day: {statistics['episodes_per_day']:.2f}",
+            f"Onset: {statistics['onset_phase']:.1f} h, offset: {statistics['offset_phase']:.1f} h",
+            f"H at onset: {statistics['mean_H_at_onset']:.2f}",
+        ]
+        ax.text(0.01, 0.99, '\n'.join(lines), transform=ax.transAxes, fontsize='x-small', va='top', ha='left',
+                bbox=dict(boxstyle='round', facecolor='white', alpha=0.7))
 
 class Visualize:
-    def __init__(self, sleep_wake_cycle_plotter):
+    def __init__(self, sleep_wake_cycle_plotter, decimate=False):
         self.sleep_wake_cycle_plotter = sleep_wake_cycle_plotter
-        self.circadian_process_plotter = CircadianProcessPlotter()
+        self.circadian_process_plotter = CircadianProcessPlotter(decimate=decimate)
         self.statistical_analysis_plotter = StatisticalAnalysisPlotter()
 
     def plot_all(self, sleep_data, ax):
-        self.sleep_wake_cycle_plotter.plot(sleep_data.time, sleep_data.sleep_starts, sleep_data.sleep_ends, sleep_data, ax)
-        self.circadian_process_plotter.plot(sleep_data, ax)
-        # Calculate statistics and plot them
-        statistics = self.statistical_analysis_plotter.calculate_statistics(sleep_data)
-        self.statistical_analysis_plotter.plot_statistics(statistics, ax)
+        with metrics.phase('plotting'):
+            self.sleep_wake_cycle_plotter.plot(sleep_data.time, sleep_data.sleep_starts, sleep_data.sleep_ends, sleep_data, ax)
+            self.circadian_process_plotter.plot(sleep_data, ax)
+            # Calculate statistics and plot them
+            statistics = self.statistical_analysis_plotter.calculate_statistics(sleep_data)
+            self.statistical_analysis_plotter.plot_statistics(statistics, ax)
         
 def plot_default_configuration(model, ts, sleep_pressure_T0, wake_status_T0):
     # Create a figure for default configuration
@@ -132,13 +208,12 @@ def plot_configurations(configurations, model, ts, sleep_pressure_T0, wake_statu
     sleep_wake_cycle_plotter = SleepWakeCyclePlotter(plot_vertical_dashed_lines=True, plot_dots_at_sleep_starts_ends=True, plot_sleep_awake_bars=True)
     visualize = Visualize(sleep_wake_cycle_plotter=sleep_wake_cycle_plotter)
 
+    # Simulate all configurations at once, each merged on top of the default parameters
+    batch = BorbelyModel(default_params).simulate_batch(configurations, ts, sleep_pressure_T0, wake_status_T0)
+
     # Loop over the configurations
     for i, config in enumerate(configurations):
-        # Create a new model instance with the merged parameters
-        model = BorbelyModel({**default_params, **config})
-
-        # Simulate the sleep data
-        sleep_data = model.simulate(ts, sleep_pressure_T0, wake_status_T0)
+        sleep_data = batch[i]
 
         # Plot the data in one of the subplots
         ax = axs[i // 3, i % 3]
@@ -184,4 +259,46 @@ def plot_sleep_wake_bars_for_all_configurations(configurations, model, ts, sleep
 
     # Adjust the layout and show the figure
     plt.tight_layout()
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+def _render_configuration(config, ts, sleep_pressure_T0, wake_status_T0, out_dir, fmt):
+    # Simulate one configuration and render it to a file without pyplot, so it works on headless workers.
+    sleep_data = BorbelyModel(default_params).simulate_batch([config], ts, sleep_pressure_T0, wake_status_T0)[0]
+
+    fig = Figure(figsize=(10, 6))
+    ax = fig.add_subplot(111)
+    sleep_wake_cycle_plotter = SleepWakeCyclePlotter(plot_vertical_dashed_lines=True, plot_dots_at_sleep_starts_ends=True, plot_sleep_awake_bars=True, fast=True)
+    Visualize(sleep_wake_cycle_plotter=sleep_wake_cycle_plotter, decimate=True).plot_all(sleep_data, ax)
+    ax.set_title(config['title'])
+    ax.legend(loc='upper right', fontsize='small')
+
+    path = os.path.join(out_dir, f"{config['simulation_key']}.{fmt}")
+    fig.savefig(path)
+    return path
+
+def render_configurations(configurations, ts, sleep_pressure_T0, wake_status_T0, out_dir, fmt='png', processes=None):
+    # Render one figure per configuration straight to out_dir/<simulation_key>.<fmt> (png, svg, ...),
+    # using the fast collection-based plotter and decimated curves, in parallel across processes.
+    os.makedirs(out_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_render_configuration, config, ts, sleep_pressure_T0, wake_status_T0, out_dir, fmt) for config in configurations]
+        return [future.result() for future in futures]
+
+def plot_phase_diagram(diagram, ax, show_points=True):
+    # Draw a 2-D phase_diagram.PhaseDiagram as a regime map, optionally with the simulated corners on top.
+    from phase_diagram import REGIMES
+    from matplotlib.colors import BoundaryNorm, ListedColormap
+
+    cmap = ListedColormap(plt.cm.tab10.colors[:len(REGIMES)])
+    norm = BoundaryNorm(np.arange(len(REGIMES) + 1) - 0.5, len(REGIMES))
+    extent = (diagram.low[0], diagram.high[0], diagram.low[1], diagram.high[1])
+    ax.imshow(diagram.grid().T, origin='lower', extent=extent, aspect='auto', cmap=cmap, norm=norm, interpolation='nearest')
+    if show_points:
+        points, _ = diagram.points()
+        ax.plot(points[:, 0], points[:, 1], 'k.', markersize=2)
+
+    present = np.unique(diagram.grid())
+    ax.legend(handles=[mpatches.Patch(color=cmap(k), label=REGIMES[k].replace('_', ' ')) for k in present], loc='upper right', fontsize='small')
+    ax.set_xlabel(diagram.names[0])
+    ax.set_ylabel(diagram.names[1])
+    ax.set_title(f"Sleep regimes ({diagram.n_evaluations} simulations)")